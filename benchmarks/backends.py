@@ -0,0 +1,38 @@
+from devcs import *
+from features import *
+from colors import devcolors as dc
+from convfuncs import num2period, num2period_half
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import os
+import sys
+
+# compare the pyx and direct writer backends on a schematic built from the
+# shapes and non-lin example geometries with dense periodic layers
+ndevices = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+density = int(sys.argv[2]) if len(sys.argv) > 2 else 50  # features per layer
+
+s = Schematic(wrap=10, ysep=60, xsep=120)
+dwidth = 100
+for i in range(ndevices):
+    d = Device(width=dwidth)
+    for feat in (Square(1, color=dc['silicon']),
+                 Rectangle(1.5, 1, color=dc['oxide']),
+                 RightTriangleUpBack(1, 2, color=dc['gate']),
+                 EquilateralTriangle(1, color=dc['n-type']),
+                 ConvexPolygon(((0, 0), (1, 0.4), (0, 0.6)), color=dc['p-type'])):
+        d.stack(Layer(period=num2period(density, feat.width, dwidth), feature=feat))
+    f = Semicircle(1, color=dc['contact'])
+    p, x0 = num2period_half(density, f.width, dwidth)
+    d.stack(Layer(period=p, feature=f, x0=x0, height=0.5))
+    s.stack(d)
+
+with TemporaryDirectory() as tmp:
+    for backend, instanced in ('pyx', False), ('direct', False), ('direct', True):
+        for format in 'eps', 'svg':
+            filename = os.path.join(tmp, '%s.%s' % (backend, format))
+            t0 = perf_counter()
+            s.write(filename, backend=backend, format=format, instanced=instanced)
+            t = perf_counter() - t0
+            print('{:10s}{:4s}{:8.3f} s{:10d} bytes'.format(
+                backend + '+i' * instanced, format, t, os.path.getsize(filename)))
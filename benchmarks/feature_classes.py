@@ -0,0 +1,54 @@
+from devcs import *
+from features import *
+from colors import devcolors as dc
+from time import perf_counter
+import sys
+import tracemalloc
+
+# memory and attribute access time of features, layers and device copies;
+# run it in checkouts of two versions to compare their feature classes
+nlayers = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+ncopies = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+repeat = 100000
+
+
+def make_device():
+    d = Device(width=100)
+    for i in range(nlayers):
+        # a few distinct features repeated over many layers, as in process flows
+        k = i % 10
+        feat = (Rectangle(10 + k, 5, color=dc['oxide']),
+                ConvexPolygon(((0, 0), (5 + k, 2), (0, 3)), color=dc['p-type']),
+                Semicircle(3 + k, color=dc['contact']))[i % 3]
+        d.stack(Layer(period=20, feature=feat))
+    return d
+
+
+def timed(label, fn, n=1):
+    t0 = perf_counter()
+    for i in range(n):
+        fn()
+    t = perf_counter() - t0
+    print('{:28s}{:10.3f} us'.format(label, 1e6 * t / n))
+
+
+tracemalloc.start()
+d = make_device()
+built = tracemalloc.get_traced_memory()[0]
+copies = [d.copy() for i in range(ncopies)]
+copied = tracemalloc.get_traced_memory()[0]
+tracemalloc.stop()
+print('{:28s}{:10.1f} kB'.format('device of %d layers' % nlayers, built / 1e3))
+print('{:28s}{:10.1f} kB'.format('%d device copies' % ncopies, (copied - built) / 1e3))
+
+poly = ConvexPolygon(((0, 0), (5, 2), (0, 3)), color=dc['p-type'])
+rect = Rectangle(10, 5)
+timed('Rectangle(10, 5)', lambda: Rectangle(10, 5), 10000)
+timed('polygon width + height', lambda: poly.width + poly.height, repeat)
+timed('polygon get_bbox', lambda: poly.get_bbox(1, 2), repeat)
+timed('polygon key', lambda: poly.key(), repeat)
+layer = Layer(period=12, feature=rect)
+timed('Layer(feature=...)', lambda: Layer(period=12, feature=rect), 10000)
+timed('Layer.copy', layer.copy, 10000)
+timed('Layer.visible', lambda: layer.visible(0, 0, 100), 10000)
+timed('Device.copy (%d layers)' % nlayers, d.copy, 10)
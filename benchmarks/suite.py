@@ -0,0 +1,179 @@
+"""Scalable benchmark suite built from the example geometries.
+
+Each axis is swept with the other axes held at their base value:
+
+    devices     number of devices in the schematic
+    instances   instances per periodic layer (period relative to device width)
+    vertices    vertex count of a ConvexPolygon and its conformal shell
+    labels      number of labelled layers
+
+For every point the phases build, place, canvas and write (pyx and direct
+backends) are timed (best of --repeat runs) and rerun under tracemalloc for
+the peak memory; the write phases also record the output file size. The
+results are saved as JSON, and --compare prints the time ratios to a
+previously saved result file to catch regressions between versions.
+
+    python benchmarks/suite.py -o results.json
+    python benchmarks/suite.py -o new.json --compare results.json
+"""
+from devcs import *
+from features import *
+from colors import devcolors as dc
+from conformal import conformal_coords
+from convfuncs import num2period, num2period_half
+from math import pi, cos, sin
+from tempfile import TemporaryDirectory
+from time import perf_counter, strftime
+import argparse
+import json
+import os
+import platform
+import sys
+import tracemalloc
+
+base = dict(devices=4, instances=10, vertices=8, labels=0)
+axes = dict(devices=(1, 4, 16, 64),
+            instances=(1, 10, 100, 1000),
+            vertices=(3, 16, 128, 1024),
+            labels=(0, 4, 16, 64))
+quick_axes = dict(devices=(1, 4, 16),
+                  instances=(1, 10, 100),
+                  vertices=(3, 16, 128),
+                  labels=(0, 4, 16))
+
+dwidth = 100
+
+
+def regular_polygon(n, r):
+    """Vertices of a regular n-gon of radius r with the lower left bbox corner at the origin."""
+    verts = [(r * cos(2 * pi * i / n), r * sin(2 * pi * i / n)) for i in range(n)]
+    xmin = min(v[0] for v in verts)
+    ymin = min(v[1] for v in verts)
+    return [(x - xmin, y - ymin) for x, y in verts]
+
+
+def build(devices, instances, vertices, labels):
+    """Build a schematic from the shapes, non-lin and finfet example geometries."""
+    s = Schematic(wrap=8, ysep=80, xsep=120)
+    for i in range(devices):
+        d = Device(width=dwidth)
+        # shapes.py
+        for feat in (Square(5, color=dc['silicon']),
+                     Rectangle(10, 5, color=dc['oxide']),
+                     RightTriangleUpBack(6, 3, color=dc['gate']),
+                     EquilateralTriangle(5, color=dc['n-type']),
+                     ConvexPolygon(((0, 0), (5, 2), (0, 3)), color=dc['p-type'])):
+            d.stack(Layer(period=num2period(instances, feat.width, dwidth),
+                          feature=feat))
+        # non-lin.py
+        f = Semicircle(3, color=dc['contact'])
+        p, x0 = num2period_half(instances, f.width, dwidth)
+        d.stack(Layer(period=p, feature=f, x0=x0, height=1))
+        # finfet.py conformal oxide around a polygon fin
+        fin = ConvexPolygon(regular_polygon(vertices, 4), color=dc['silicon'])
+        shell = ConvexPolygon(conformal_coords(fin.coords, thx=1), color=dc['oxide'])
+        p = num2period(instances, shell.width, dwidth)
+        d.stack([Layer(period=p, feature=shell, x0=1, height=shell.height),
+                 Layer(period=p, feature=fin)])
+        s.stack(d)
+    devs = [d for d, xy in s.devices_xy]
+    for i in range(labels):
+        devs[i % devices].stack(Layer(feature=Rectangle(dwidth, 3, color=dc['gate']),
+                                      text='label %d' % i))
+    return s
+
+
+def measure(fn, repeat):
+    """Return the result of fn, its best wall time and its peak traced memory."""
+    best = float('inf')
+    for i in range(repeat):
+        t0 = perf_counter()
+        result = fn()
+        best = min(best, perf_counter() - t0)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def run_point(params, repeat, tmp):
+    phases = {}
+    s, t, m = measure(lambda: build(**params), repeat)
+    phases['build'] = dict(seconds=t, peak_bytes=m)
+    laypaths, t, m = measure(lambda: [l for d in s.place(0, 0) for l in d], repeat)
+    phases['place'] = dict(seconds=t, peak_bytes=m)
+    _, t, m = measure(lambda: [layer_canvas(l) for l in laypaths], repeat)
+    phases['canvas'] = dict(seconds=t, peak_bytes=m)
+    for backend in 'pyx', 'direct':
+        filename = os.path.join(tmp, backend + '.eps')
+        _, t, m = measure(lambda: s.write(filename, backend=backend), repeat)
+        phases['write_' + backend] = dict(seconds=t, peak_bytes=m,
+                                          file_bytes=os.path.getsize(filename))
+    return phases
+
+
+def run(sweep, repeat):
+    results = []
+    with TemporaryDirectory() as tmp:
+        for axis, values in sweep.items():
+            for value in values:
+                params = dict(base, **{axis: value})
+                phases = run_point(params, repeat, tmp)
+                results.append(dict(axis=axis, value=value, params=params,
+                                    phases=phases))
+                print('{:10s}{:6d}  '.format(axis, value) + '  '.join(
+                    '{} {:.4f} s'.format(name, ph['seconds'])
+                    for name, ph in phases.items()), flush=True)
+    return results
+
+
+def compare(results, old):
+    """Print the wall time ratio new/old of every phase present in both results."""
+    old = {(r['axis'], r['value']): r['phases'] for r in old['results']}
+    for r in results:
+        prev = old.get((r['axis'], r['value']))
+        if prev is None:
+            continue
+        print('{:10s}{:6d}  '.format(r['axis'], r['value']) + '  '.join(
+            '{} x{:.2f}'.format(name, ph['seconds'] / prev[name]['seconds'])
+            for name, ph in r['phases'].items()
+            if name in prev and prev[name]['seconds'] > 0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='JSON results file')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='timed runs per phase, the best is reported')
+    parser.add_argument('-a', '--axis', action='append', choices=sorted(axes),
+                        help='sweep only this axis (may be repeated)')
+    parser.add_argument('--quick', action='store_true',
+                        help='smaller sweeps for a fast check')
+    parser.add_argument('--compare', help='previous JSON results file')
+    args = parser.parse_args(argv)
+
+    sweep = quick_axes if args.quick else axes
+    if args.axis:
+        sweep = {a: sweep[a] for a in args.axis}
+    results = run(sweep, args.repeat)
+    import numpy
+    import pyx
+    out = dict(date=strftime('%Y-%m-%dT%H:%M:%S'),
+               python=sys.version.split()[0],
+               numpy=numpy.__version__,
+               pyx=pyx.__version__,
+               platform=platform.platform(),
+               repeat=args.repeat,
+               base=base,
+               results=results)
+    with open(args.output, 'w') as f:
+        json.dump(out, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
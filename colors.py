@@ -1,14 +1,75 @@
-from pyx import color
-
-devcolors = {'n-type': color.rgb.red,
-             'gate': color.rgb(0.4,
-                               0.4,
-                               0.4),
-             'p-type': color.rgb(0.5,
-                                 0.5,
-                                 0),
-             'oxide': color.rgb.black,
-             'silicon': color.rgb.blue,
-             'contact': color.rgb(0.8,
-                                  0.4,
-                                  0)}
+class rgb:
+    """A color given by its red, green and blue components. It stands in for
+    pyx.color.rgb so that features can be built without importing pyx; it is
+    converted to a pyx color (see to_pyx) when the feature is rendered.
+
+    r:
+        type: float
+        default: 0.
+        description: the red component from 0 to 1
+    g:
+        type: float
+        default: 0.
+        description: the green component from 0 to 1
+    b:
+        type: float
+        default: 0.
+        description: the blue component from 0 to 1
+
+    """
+
+    def __init__(self, r=0., g=0., b=0.):
+        self.r = r
+        self.g = g
+        self.b = b
+
+    def __repr__(self):
+        return 'rgb({}, {}, {})'.format(self.r, self.g, self.b)
+
+    def rgb(self):
+        return self
+
+
+rgb.red = rgb(1, 0, 0)
+rgb.green = rgb(0, 1, 0)
+rgb.blue = rgb(0, 0, 1)
+rgb.white = rgb(1, 1, 1)
+rgb.black = rgb(0, 0, 0)
+
+devcolors = {'n-type': rgb.red,
+             'gate': rgb(0.4,
+                         0.4,
+                         0.4),
+             'p-type': rgb(0.5,
+                           0.5,
+                           0),
+             'oxide': rgb.black,
+             'silicon': rgb.blue,
+             'contact': rgb(0.8,
+                            0.4,
+                            0)}
+
+
+def color_key(c):
+    """Return a hashable key of the content of a color (None for no color).
+    An rgb color has the same key as the pyx color it converts to."""
+    if c is None:
+        return None
+    if type(c) is rgb:  # the same key as below, without vars and sorting
+        return ('rgb', ('b', c.b), ('g', c.g), ('r', c.r))
+    return (type(c).__name__,) + tuple(
+        (k, v) for k, v in sorted(vars(c).items()) if k != 'exclusiveclass')
+
+
+def to_rgb(c):
+    """Return the (r, g, b) components of an rgb or pyx color."""
+    c = c.rgb()
+    return (c.r, c.g, c.b)
+
+
+def to_pyx(c):
+    """Return the pyx color of an rgb color; pyx colors and None are returned as they are."""
+    if isinstance(c, rgb):
+        from pyx import color
+        return color.rgb(c.r, c.g, c.b)
+    return c
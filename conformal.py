@@ -5,7 +5,7 @@ R = np.array([[0, 1], [-1, 0]])  # need transpose?
 
 def si_perp_bisec(pi, pip1):
     intercept = (pi + pip1) / 2
-    slope = R @ (pip1 - pi)
+    slope = (pip1 - pi) @ R.T
     return slope, intercept
 
 
@@ -16,13 +16,18 @@ def si_ang_bisec(pim1, pi, pip1):
 
 
 def calc_intercept(slope1, intercept1, slope2, intercept2):
-    coeff = np.array([slope1, -slope2]).transpose()
+    """Intercept of the lines x*slope1 + intercept1 and x'*slope2 + intercept2.
+    The 2x2 system is solved in closed form (Cramer's rule), so the arguments
+    may be stacks of vectors of shape (..., 2). Raises LinAlgError if any pair
+    of lines is parallel or degenerate (e.g. at collinear or repeated vertices)."""
     inter = intercept2 - intercept1
-    extent = la.solve(coeff, inter)
-    # test that the equation was solved (solution should be exact)
-    assert (abs((extent[0] * slope1 + intercept1) -
-                (extent[1] * slope2 + intercept2)) < 0.001).all()
-    return extent[0] * slope1 + intercept1
+    det = slope2[..., 0] * slope1[..., 1] - slope1[..., 0] * slope2[..., 1]
+    scale = la.norm(slope1, axis=-1) * la.norm(slope2, axis=-1)
+    if not (np.abs(det) > 1e-12 * scale).all():
+        raise la.LinAlgError('Singular matrix')
+    extent = (slope2[..., 0] * inter[..., 1] -
+              inter[..., 0] * slope2[..., 1]) / det
+    return extent[..., None] * slope1 + intercept1
 
 
 def calc_cosine(a, b, c):
@@ -30,9 +35,19 @@ def calc_cosine(a, b, c):
     going from points b->a and b->c"""
     r1 = a - b
     r2 = c - b
-    r1 = r1 / np.linalg.norm(r1)
-    r2 = r2 / np.linalg.norm(r2)
-    return np.dot(r1, r2)  # returns the cosine of angle
+    r1 = r1 / la.norm(r1, axis=-1, keepdims=True)
+    r2 = r2 / la.norm(r2, axis=-1, keepdims=True)
+    return (r1 * r2).sum(axis=-1)  # returns the cosine of angle
+
+
+def normalized(v):
+    return v / la.norm(v, axis=-1, keepdims=True)
+
+
+def outward(slope, intercept, centroid):
+    """Flip the slopes which point towards the centroid."""
+    sign = np.where(((intercept - centroid) * slope).sum(axis=-1) < 0, -1, 1)
+    return slope * sign[..., None]
 
 
 def sort_verts(verts):
@@ -42,58 +57,73 @@ def sort_verts(verts):
 
 
 def conformal_coords(verts, thx=0.05, lowerleftorigin=False):
-    """Create the coordinates of a conformal layer on a polygon.  Loops
-    through the n vertices, at each vertex calculating the coordinates for the
-    half-edges to the perpendicular bisectors neighboring that vertex. """
-
-    if isinstance(verts, list) or isinstance(verts, tuple):
-        verts = np.array(verts)
-
-    centroid = verts.mean(axis=0)
-    coords = []
-    n = len(verts)
-    for i in range(n):  # there are actually n-1 edges
-        pi = verts[i]
-        pip1 = verts[(i + 1) % n]
-        pim1 = verts[i - 1]
-        abi_s, abi_i = si_ang_bisec(pim1, pi, pip1)
-        j = 0
-        for v in pim1, pip1:
-            pbi_s, pbi_i = si_perp_bisec(pi, v)
-            pai = calc_intercept(pbi_s, pbi_i, abi_s, abi_i)
-            # test that the perpendicular bisector is closer to the intercept
-            # than the angular bisector
-            assert la.norm(pbi_i - pai) < la.norm(abi_i - pai)
-            # test that the slope vector is pointing outward, that is, away from the origin
-            # dot product with radial vector at that point is positive
-            if np.dot(pbi_s, pbi_i - centroid) < 0:
-                pbi_s *= -1
-            if np.dot(abi_s, abi_i - centroid) < 0:
-                abi_s *= -1
-
-            cost = calc_cosine(pbi_i, pai, abi_i)
-
-            if j == 0:
-                ei = pbi_i + pbi_s / np.linalg.norm(pbi_s) * thx
-                ai0 = abi_i + abi_s / np.linalg.norm(abi_s) * thx / cost
-            else:
-                eip1 = pbi_i + pbi_s / np.linalg.norm(pbi_s) * thx
-                ai1 = abi_i + abi_s / np.linalg.norm(abi_s) * thx / cost
-
-            j += 1
-
-        slope1 = ai0 - ei
-        slope2 = ai1 - eip1
-        intercept1 = ei
-        intercept2 = eip1
-        intercept = calc_intercept(slope1, intercept1, slope2, intercept2)
-
-        coords.extend((eip1, intercept, ei))
-
-    coords = np.array(coords)
+    """Create the coordinates of a conformal layer on a polygon.  For each of
+    the n vertices the coordinates for the half-edges to the perpendicular
+    bisectors neighboring that vertex are calculated, all vertices at once. """
+
+    return conformal_coords_many(np.asarray(verts, dtype=float), thx,
+                                 lowerleftorigin)
+
+
+def conformal_coords_many(verts, thx=0.05, lowerleftorigin=False):
+    """Create the coordinates of conformal layers on a stack of polygons.
+
+    verts has shape (..., n, 2), e.g. (m, n, 2) for m polygons of n vertices,
+    and thx is a scalar or broadcasts against the leading dimensions. Returns
+    an array of shape (..., 3n, 2) where each vertex is replaced by the
+    conformal coordinates on its two neighboring perpendicular bisectors and
+    their common intercept on the angle bisector."""
+
+    verts = np.asarray(verts, dtype=float)
+    thx = np.asarray(thx, dtype=float)[..., None, None]
+    centroid = verts.mean(axis=-2, keepdims=True)
+    pi = verts
+    pip1 = np.roll(verts, -1, axis=-2)
+    pim1 = np.roll(verts, 1, axis=-2)
+    abi_s, abi_i = si_ang_bisec(pim1, pi, pip1)
+    bisectors = [si_perp_bisec(pi, v) for v in (pim1, pip1)]
+    # raises for collinear or repeated vertices before anything is normalized
+    intercepts = [calc_intercept(pbi_s, pbi_i, abi_s, abi_i)
+                  for pbi_s, pbi_i in bisectors]
+    abi_u = normalized(outward(abi_s, abi_i, centroid))
+
+    shells = []
+    for (pbi_s, pbi_i), pai in zip(bisectors, intercepts):
+        cost = calc_cosine(pbi_i, pai, abi_i)[..., None]
+        e = pbi_i + normalized(outward(pbi_s, pbi_i, centroid)) * thx
+        a = abi_i + abi_u * thx / cost
+        shells.append((e, a))
+    (ei, ai0), (eip1, ai1) = shells
+
+    intercept = calc_intercept(ai0 - ei, ei, ai1 - eip1, eip1)
+
+    coords = np.stack((eip1, intercept, ei), axis=-2)
+    coords = coords.reshape(verts.shape[:-2] + (-1, 2))
     if lowerleftorigin:
-        coords = coords - coords.min(axis=0)
-    return np.array(coords)
+        coords = coords - coords.min(axis=-2, keepdims=True)
+    return coords
+
+
+def conformal_shells(verts, thicknesses, lowerleftorigin=False):
+    """Create k nested conformal layers (e.g. oxide, gate, spacer) on a polygon.
+
+    Shell i lies at the cumulative thickness of shells 0 to i and is computed
+    from the original n vertices, all shells at once, so every shell has 3n
+    coordinates instead of growing threefold with each conformal_coords call
+    on the previous shell. Returns the coordinates of the shells, an array of
+    shape (k, 3n, 2) whose rows can be passed to ConvexPolygon, and the y
+    extent of each shell (its Layer height). With lowerleftorigin all shells
+    are shifted together so that the outermost one starts at the origin and
+    they still nest."""
+
+    verts = np.asarray(verts, dtype=float)
+    cumulative = np.cumsum(np.asarray(thicknesses, dtype=float))
+    coords = conformal_coords_many(
+        np.broadcast_to(verts, cumulative.shape + verts.shape), cumulative)
+    if lowerleftorigin and len(coords):
+        coords = coords - coords[-1].min(axis=0)
+    heights = coords[..., 1].max(axis=-1) - coords[..., 1].min(axis=-1)
+    return coords, heights
 
 
 if __name__ == '__main__':
@@ -1,7 +1,16 @@
 from math import floor
+from numpy import broadcast_arrays, floor as floor_, isscalar, where
+
+
+def _arrays(*args):
+    # whether any argument is an array (e.g. a column of a sweep grid)
+    return not all(isscalar(a) for a in args)
 
 
 def num2period(num, fwidth, dwidth):
+    if _arrays(num, fwidth, dwidth):
+        num, fwidth, dwidth = broadcast_arrays(num, fwidth, dwidth)
+        return where(num == 1, dwidth, (dwidth - fwidth) / (where(num == 1, 2, num) - 1))
     if num == 1:
         period = dwidth
     else:
@@ -10,11 +19,15 @@ def num2period(num, fwidth, dwidth):
 
 
 def num2period_half(num, fwidth, dwidth):
+    if _arrays(num, fwidth, dwidth):
+        num, fwidth, dwidth = broadcast_arrays(num, fwidth, dwidth)
     return dwidth / num, -fwidth / 2
 
 
 def spacingsreqs(fwidth, swidth, dwidth):
+    if _arrays(fwidth, swidth, dwidth):
+        fwidth, swidth, dwidth = broadcast_arrays(fwidth, swidth, dwidth)
     p = fwidth + swidth
     d = dwidth - fwidth
-    n = floor(d / p)
+    n = floor_(d / p) if _arrays(p) else floor(d / p)
     return p, 0.5 * (d - n * p)
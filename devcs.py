@@ -1,13 +1,18 @@
-from collections import deque
+from array import array as array_
+from collections import OrderedDict, defaultdict, deque
 from features import *
 from numpy import arctan2, sqrt
 from numpy.linalg import norm
-from numpy import array, roll, sqrt, argmin
+from numpy import array, roll, sqrt, argmin, arange
 from math import ceil, floor, nan, isnan
-from pyx import path, canvas as pyxcanvas, color as pyxcolor, text, style
-text.set(text.UnicodeEngine)
+from os import environ
+from shutil import copyfileobj
+from tempfile import TemporaryFile
+from time import perf_counter
+# pyx is imported when a schematic is first drawn, so that devices, layers and
+# features can be built without it
 
-eps = 0.01  # numerical tolerance
+eps = 1e-9  # numerical tolerance (relative to the device width)
 
 
 class Schematic:
@@ -34,21 +39,48 @@ class Schematic:
         default: 0
         description: current position is the current number of devices which determines modulo wrap the x- and y-shift
     canvas:
-        type: pyxcanvas.canvas
+        type: pyx.canvas.canvas
         default: None
-        description: the canvas on which to draw the schematic
+        description: the canvas on which to draw the schematic (created when first used)
 
     """
 
     def __init__(self, wrap=10000  # don't use inf/nan since it is floating point and casts integers to floats
-                 , ysep=100., xsep=50., devices_xy=deque(), current_position=0, canvas=None):
+                 , ysep=100., xsep=50., devices_xy=None, current_position=0, canvas=None):
         self.wrap = wrap
         self.current_position = current_position
+        if devices_xy is None:
+            devices_xy = deque()
         self.devices_xy = devices_xy
         self.xsep = xsep
         self.ysep = ysep
-        if canvas is None:
-            self.canvas = pyxcanvas.canvas()
+        self._canvas = canvas
+
+    @property
+    def canvas(self):
+        if self._canvas is None:
+            from pyx import canvas as pyxcanvas
+            self._canvas = pyxcanvas.canvas()
+        return self._canvas
+
+    @canvas.setter
+    def canvas(self, canvas):
+        self._canvas = canvas
+
+    def __getstate__(self):
+        # the canvas refers to the text engine, so only its items are pickled
+        state = self.__dict__.copy()
+        if self._canvas is not None:
+            state['_canvas'] = list(self._canvas.items)
+        return state
+
+    def __setstate__(self, state):
+        items = state.pop('_canvas')
+        self.__dict__.update(state)
+        self._canvas = None
+        if items is not None:
+            for item in items:
+                self.canvas.insert(item)
 
     def __len__(self):
         return len(self.devices)
@@ -69,8 +101,22 @@ class Schematic:
             dp.append(self.devices_xy.pop())
         return dp
 
-    def place(self, x, y):
-        return (d[0].place(x + d[1][0], y + d[1][1]) for d in self.devices_xy)
+    def place(self, x, y, batched=False, stats=None, columnar=False):
+        """Place the devices shifted by (x, y), as a generator of the placed
+        layers of each device or, if columnar, as a geometry.PlacedGeometry."""
+        if columnar:
+            from geometry import PlacedGeometry
+            return PlacedGeometry.from_schematic(self, x, y)
+        if stats is not None:
+            return self._place_profiled(x, y, batched, stats)
+        return (d[0].place(x + d[1][0], y + d[1][1], batched)
+                for d in self.devices_xy)
+
+    def _place_profiled(self, x, y, batched, stats):
+        for i, (device, (xshift, yshift)) in enumerate(self.devices_xy):
+            stats.device = i
+            yield device.place(x + xshift, y + yshift, batched, stats)
+        stats.device = None
 
     def copy(self):
         devices_xy = deque((d[0].copy(), d[1]) for d in self.devices_xy)
@@ -84,47 +130,557 @@ class Schematic:
     def reverse(self):
         self.devices_xy.reverse()
 
-    def write(self, filename='schematic'):
-        schpath = self.place(0, 0)
-        for cdev, devpath in enumerate(schpath):
-            for clay, laypath in enumerate(devpath):
-                laypath, laybbox, laytext = laypath
-                laybbox_path = laybbox.to_path()
-                laycanv = pyxcanvas.canvas([
-                    pyxcanvas.clip(laybbox_path)])
+    def write(self, filename='schematic', batched=False, stream=False, cache=None,
+              backend='pyx', format='eps', stats=None, workers=None, merge=False,
+              instanced=False):
+        """Write the schematic to an EPS (format='eps') or SVG (format='svg') file.
+        If batched, the instances of each periodic layer are placed as one compound path.
+        If stream, devices are placed and serialized one at a time (see write_stream).
+        If a RenderCache is given, unchanged devices and layers are reused from it.
+        With backend='direct' polygons and semicircles are written straight from
+        their coordinates without building pyx objects (see direct.py), and
+        if instanced each unique feature is written once as a PostScript
+        procedure or SVG definition which its instances translate and reuse.
+        If a RenderStats is given, the time and counts of each phase are
+        recorded in it by device and layer, and it is returned.
+        The labels of all layers are typeset once each before drawing.
+        If workers is given, the devices are placed over a process pool of that
+        many workers (None for all cores). With the pyx backend the workers
+        return the placed layers as plain arrays, which are drawn here (see
+        render.place_devices); with backend='direct' (EPS files only) they
+        return the PostScript of each layer and the file is only assembled
+        here (see render.serialize_devices). The per-layer stats are then not
+        recorded, and a cache or batched cannot be used.
+        If merge, abutting rectangles of the same color in a device are drawn
+        as single outlines (see geometry.PlacedGeometry.merged).
+        If the environment variable DEVCS_RENDER_SERVER is the socket of a
+        render server, the schematic is written by the server (see server.py),
+        unless a cache or stats are given since they live in this process;
+        if the server cannot be reached it is written here after a warning.
+        Combinations of options which are not supported together raise a ValueError."""
+        if merge and (stream or batched or instanced or cache is not None or
+                      workers is not None):
+            raise ValueError('merge cannot be combined with stream, batched, '
+                             'instanced, cache or workers')
+        if backend == 'direct' and (stream or batched or cache is not None):
+            raise ValueError("backend='direct' cannot be combined with stream, "
+                             'batched or cache')
+        if instanced and backend != 'direct':
+            raise ValueError("instanced requires backend='direct'")
+        if workers is not None and (cache is not None or batched):
+            raise ValueError('a cache or batched cannot be used with workers')
+        if workers is not None and backend == 'direct' and (instanced or format != 'eps'):
+            raise ValueError("backend='direct' with workers only writes EPS files "
+                             'without instanced')
+        address = environ.get('DEVCS_RENDER_SERVER')
+        if address and cache is None and stats is None:
+            from server import write_remote
+            if write_remote(address, self, filename, batched=batched, stream=stream,
+                            backend=backend, format=format, workers=workers,
+                            merge=merge, instanced=instanced):
+                return
+        if stats is not None:
+            t0 = perf_counter()
+        unique_labels = labels.typeset(
+            layer.text for device, shift in self.devices_xy
+            for layer, ly in device.layers_y if layer.text != '')
+        if stats is not None:
+            stats.add('typeset', perf_counter() - t0, unique_labels=unique_labels)
+        if merge:
+            if stats is not None:
+                t0 = perf_counter()
+            geometry = self.place(0, 0, columnar=True)
+            merged = geometry.merged()
+            merged.write(filename, format, backend, canvas=self.canvas)
+            if stats is not None:
+                stats.add('write', perf_counter() - t0, paths=len(geometry),
+                          merged_paths=len(merged))
+            return stats
+        if backend == 'direct':
+            from direct import write_direct
+            from render import write_serialized
+            if stats is not None:
+                t0 = perf_counter()
+            if workers is None:
+                write_direct(self, filename, format, instanced)
+            else:
+                write_serialized(self, filename, workers)
+            if stats is not None:
+                stats.add('write', perf_counter() - t0)
+            return stats
+        if backend != 'pyx':
+            raise ValueError('unknown backend %r' % backend)
+        if format not in ('eps', 'svg'):
+            raise ValueError('unknown format %r' % format)
+        if stream:
+            if format != 'eps':
+                raise ValueError('only EPS files can be streamed')
+            return self.write_stream(filename, batched, cache, stats, workers)
+        # draw on a new canvas so that the schematic can be written again
+        from pyx import canvas as pyxcanvas
+        canvas = pyxcanvas.canvas()
+        canvas.insert(self.canvas)
+        if workers is not None:
+            from render import placed_canvases
+            for laycanvs in placed_canvases(self, workers, batched):
+                for laycanv in laycanvs:
+                    canvas.insert(laycanv)
+        for i, (device, (xshift, yshift)) in enumerate(
+                self.devices_xy if workers is None else ()):
+            if stats is not None:
+                stats.device = i
+            for laycanv in device_canvases(device, xshift, yshift, batched, cache,
+                                           stats):
+                canvas.insert(laycanv)
+
+        if stats is not None:
+            stats.device = stats.layer = None
+            t0 = perf_counter()
+        if format == 'svg':
+            canvas.writeSVGfile(filename)
+        else:
+            canvas.writeEPSfile(filename)
+        if stats is not None:
+            stats.add('serialize', perf_counter() - t0)
+            return stats
+
+    def write_stream(self, filename='schematic', batched=False, cache=None,
+                     stats=None, workers=None):
+        """Write the schematic to an EPS file with memory bounded by the largest device.
+
+        Each device is placed from the place generator, its layer canvases are
+        serialized to a temporary file and then released. The header, which
+        needs the bounding box and the prolog resources, is written last and
+        followed by the temporary body. The output matches write.
+        With workers the devices are placed over a process pool (see
+        render.placed_canvases).
+        """
+        page = EPSStream()
+        page.insert(self.canvas)
+        if workers is not None:
+            from render import placed_canvases
+            for laycanvs in placed_canvases(self, workers, batched):
+                for laycanv in laycanvs:
+                    page.insert(laycanv)
+        for i, (device, (xshift, yshift)) in enumerate(
+                self.devices_xy if workers is None else ()):
+            if stats is None:
+                for laycanv in device_canvases(device, xshift, yshift, batched, cache):
+                    page.insert(laycanv)
+                continue
+            stats.device = i
+            laycanvs = device_canvases(device, xshift, yshift, batched, cache, stats)
+            stats.layer = None
+            t0 = perf_counter()
+            for laycanv in laycanvs:
+                page.insert(laycanv)
+            stats.add('serialize', perf_counter() - t0)
+        if stats is None:
+            return page.save(filename)
+        stats.device = stats.layer = None
+        t0 = perf_counter()
+        page.save(filename)
+        stats.add('serialize', perf_counter() - t0)
+        return stats
 
-                for cfea, feapath in enumerate(laypath):
-                    feapath, color, stroke_color = feapath
-                    laycanv.fill(feapath, [color])
-                    if stroke_color is None:
-                        laycanv.stroke(feapath, [stroke_color])
+    def preview(self, filename='schematic', dpi=72, supersample=2):
+        """Rasterize the placed features with NumPy and save them as a PNG thumbnail.
 
-                if laytext != '':
-                    xc = (laybbox.x1 + laybbox.x2) / 2
-                    yc = (laybbox.y1 + laybbox.y2) / 2
-                    t = text.Text(laytext, scale=2)
-                    laycanv.text(xc, yc, t)
+        Polygons and semicircles are filled by a vectorized scanline fill
+        (see raster.py) without pyx or an external process; layer text and
+        lines drawn on the schematic canvas are left out. Return the image.
+        """
+        from raster import rasterize, write_png
+        image = rasterize(self.place(0, 0, columnar=True), dpi, supersample)
+        write_png(filename, image)
+        return image
 
-                self.canvas.insert(laycanv)
+    def write_shards(self, filename='schematic', tile=None, format='eps', workers=None,
+                     batched=False):
+        """Write the schematic as one file per column of devices or, with
+        tile=(width, height), per tile, in parallel, with an index file
+        filename.json of where each shard sits (see render.write_shards)."""
+        from render import write_shards
+        return write_shards(self, filename, tile, format, workers, batched)
 
-        self.canvas.writeEPSfile(filename)
+    def index(self, cell=None):
+        """Return a spatial.SchematicIndex of the device and layer bounding boxes
+        for point and window queries and for writing only a viewport."""
+        from spatial import SchematicIndex
+        return SchematicIndex(self, cell)
 
     def stroke_line(self, x1, y1, x2, y2):
+        from pyx import path, color as pyxcolor, style
         self.canvas.stroke(
             path.line(
                 x1, y1, x2, y2), [
                 style.linewidth.THICK, pyxcolor.rgb.red])
 
 
+class EPSStream:
+    """An EPS page whose body is serialized to a temporary file as it is drawn.
+
+    This mirrors pyx.pswriter.EPSwriter: the header, which needs the bounding
+    box and the prolog resources, is written by save and followed by the body.
+    pyx canvases are serialized with insert, and PostScript written directly
+    with write has its bounding box (in pt) added with add_bbox. Definitions
+    the body needs, which are only known once it is drawn, can be appended
+    to prolog until the page is saved.
+    """
+
+    def __init__(self):
+        from pyx import bbox as pyxbbox, pswriter, style, writer
+        self.psw = pswriter._PSwriter()
+        self.registry = pswriter.PSregistry()
+        self.items_bbox = pyxbbox.empty()
+        self.drawn_bbox = pyxbbox.empty()
+        self.prolog = []
+        self.tmp = TemporaryFile()
+        self.body = writer.writer(self.tmp)
+        acontext = pswriter.context()
+        style.linewidth.normal.processPS(self.body, self.psw, acontext, self.registry)
+        self.context = acontext()
+
+    def insert(self, canvas):
+        self.items_bbox += canvas.bbox()
+        canvas.processPS(self.body, self.psw, self.context, self.registry,
+                         self.drawn_bbox)
+
+    def write(self, ps):
+        self.body.write(ps)
+
+    def add_bbox(self, llx_pt, lly_pt, urx_pt, ury_pt):
+        from pyx import bbox as pyxbbox
+        self.items_bbox += pyxbbox.bbox_pt(llx_pt, lly_pt, urx_pt, ury_pt)
+
+    def save(self, filename):
+        from pyx import unit, writer
+        if not filename.endswith('.eps'):
+            filename += '.eps'
+        pagebbox = self.items_bbox
+        pagebbox.enlarge(1 * unit.t_pt)
+        pagebbox += self.drawn_bbox
+        with self.tmp, open(filename, 'wb') as f:
+            out = writer.writer(f)
+            out.write("%!PS-Adobe-3.0 EPSF-3.0\n")
+            if pagebbox:
+                out.write("%%%%BoundingBox: %d %d %d %d\n" % pagebbox.lowrestuple_pt())
+                out.write("%%%%HiResBoundingBox: %g %g %g %g\n" % pagebbox.highrestuple_pt())
+            self.psw.writeinfo(out)
+            out.write("%%EndComments\n")
+            out.write("%%BeginProlog\n")
+            self.registry.output(out, self.psw)
+            for ps in self.prolog:
+                out.write(ps)
+            out.write("%%EndProlog\n")
+            self.tmp.seek(0)
+            copyfileobj(self.tmp, f)
+            out.write("showpage\n")
+            out.write("%%Trailer\n")
+            out.write("%%EOF\n")
+
+
+_text_engine_set = False
+
+
+def set_text_engine():
+    """Set the pyx text engine to the UnicodeEngine before the first label is drawn,
+    unless another engine than the pyx default has been set with pyx.text.set."""
+    global _text_engine_set
+    if _text_engine_set:
+        return
+    from pyx import text
+    if type(text.defaulttextengine) is text.TexEngine:
+        text.set(text.UnicodeEngine)
+    _text_engine_set = True
+
+
+class LabelCache:
+    """Typeset labels keyed on (string, scale). Each unique label is typeset
+    once at the origin and inserted, translated, wherever it is placed. The
+    cache is emptied when the pyx text engine is changed.
+
+    boxes:
+        type: dict
+        description: the typeset text boxes keyed on (string, scale)
+    engine:
+        type: pyx text engine
+        description: the engine the boxes were typeset with
+
+    """
+
+    def __init__(self):
+        self.boxes = {}
+        self.engine = None
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def get(self, label, scale=2):
+        """Return the text box of a label at the origin, typesetting it if needed."""
+        from pyx import text
+        set_text_engine()
+        if text.defaulttextengine is not self.engine:
+            self.boxes.clear()
+            self.engine = text.defaulttextengine
+        key = (label, scale)
+        box = self.boxes.get(key)
+        if box is None:
+            box = self.boxes[key] = typeset_label(self.engine, label, scale)
+        return box
+
+    def typeset(self, labels, scale=2):
+        """Typeset all unique labels in one pass ahead of drawing. With a TeX
+        engine they are all sent to the same TeX process, and pyx reads their
+        DVI pages together when the page is written. Returns the number of
+        unique labels."""
+        unique = sorted(set(labels))
+        for label in unique:
+            self.get(label, scale)
+        return len(unique)
+
+    def clear(self):
+        self.boxes.clear()
+        self.engine = None
+
+
+def typeset_label(engine, label, scale):
+    from pyx import text, trafo
+    if isinstance(engine, text.MultiEngine):  # TeX and LaTeX
+        return engine.text_pt(0, 0, label, [trafo.scale(scale)])
+    return engine.text_pt(0, 0, text.Text(label, scale=scale))
+
+
+labels = LabelCache()
+
+
+def label_overflows(label, laybbox):
+    """Whether a label placed at the center of a layer bounding box extends past it,
+    in which case layer_canvas clips the layer."""
+    from pyx import trafo
+    xc = (laybbox.x1 + laybbox.x2) / 2
+    yc = (laybbox.y1 + laybbox.y2) / 2
+    tb = labels.get(label).bbox().transformed(trafo.translate(xc, yc))
+    lb = laybbox.to_path().bbox()
+    return not (lb.llx_pt <= tb.llx_pt and tb.urx_pt <= lb.urx_pt and
+                lb.lly_pt <= tb.lly_pt and tb.ury_pt <= lb.ury_pt)
+
+
+def layer_canvas(laypath, stats=None):
+    """Draw a placed layer (features, bounding box, text and clip flag) on a canvas.
+    The canvas is clipped to the layer bounding box only if the layer requires
+    it or the text extends past the bounding box."""
+    from pyx import canvas as pyxcanvas, trafo
+    laypath, laybbox, laytext, clip = laypath
+    if stats is not None:
+        t0 = perf_counter()
+    laycanv = pyxcanvas.canvas()
+
+    for cfea, feapath in enumerate(laypath):
+        feapath, color, stroke_color = feapath
+        laycanv.fill(feapath, [color])
+        if stroke_color is None:
+            laycanv.stroke(feapath, [stroke_color])
+    if stats is not None:
+        t1 = perf_counter()
+        stats.add('fill', t1 - t0, paths=len(laypath))
+
+    if laytext != '':
+        xc = (laybbox.x1 + laybbox.x2) / 2
+        yc = (laybbox.y1 + laybbox.y2) / 2
+        laycanv.insert(labels.get(laytext), [trafo.translate(xc, yc)])
+        clip = clip or label_overflows(laytext, laybbox)
+        if stats is not None:
+            t2 = perf_counter()
+            stats.add('text', t2 - t1, labels=1)
+            t1 = t2
+
+    if not clip:
+        return laycanv
+    clipcanv = pyxcanvas.canvas([pyxcanvas.clip(laybbox.to_path())])
+    clipcanv.insert(laycanv)
+    if stats is not None:
+        stats.add('clip', perf_counter() - t1, clips=1)
+    return clipcanv
+
+
+def device_canvases(device, x, y, batched=False, cache=None, stats=None):
+    """Return the layer canvases of a device placed at (x, y).
+    With a RenderCache the canvases of an unchanged device, or else of its
+    unchanged layers, are taken from the cache."""
+    if cache is None:
+        return [layer_canvas(laypath, stats)
+                for laypath in device.place(x, y, batched, stats)]
+
+    layers_yh = device.layers_yh
+    dkey = ('device', device.width, batched, x, y,
+            tuple((l.key(), ly, h) for l, ly, h in layers_yh))
+    laycanvs = cache.get(dkey)
+    if laycanvs is None:
+        laycanvs = []
+        for j, (layer, ly, h) in enumerate(layers_yh):
+            if stats is not None:
+                stats.layer = j
+            lkey = ('layer', layer.key(), device.width, batched, x, y + ly, h)
+            laycanv = cache.get(lkey)
+            if laycanv is None:
+                laycanv = layer_canvas(
+                    layer.place(x, y + ly, device.width, batched, stats, h), stats)
+                cache.put(lkey, laycanv)
+            elif stats is not None:
+                stats.add('cache', 0., hits=1)
+            laycanvs.append(laycanv)
+        cache.put(dkey, laycanvs)
+    elif stats is not None:
+        stats.layer = None
+        stats.add('cache', 0., hits=1)
+    return laycanvs
+
+
+class RenderCache:
+    """A least recently used cache of rendered layer canvases and devices.
+    Entries are keyed on the content of the layers (feature geometry, colors,
+    period, x0, height and text), the device width and the position, so a
+    layer or device which is unchanged between writes is not placed again.
+
+    maxsize:
+        type: int
+        default: 4096
+        description: the number of entries (layers and devices) kept before the least recently used is evicted
+    hits:
+        type: int
+        description: the number of lookups found in the cache
+    misses:
+        type: int
+        description: the number of lookups not found in the cache
+
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class RenderStats:
+    """Per-phase timings and counts of a write, broken down by device and layer.
+    Pass an instance to Schematic.write (or Device.place and Layer.place); when
+    no stats object is given nothing is timed or counted.
+
+    The phases are place (Layer.place, counting the instances placed and
+    trimmed), fill (counting the paths filled), text (counting the labels set),
+    clip (counting the clip canvases), cache (counting the cache hits),
+    typeset (the unique labels typeset ahead of drawing),
+    serialize (EPS/SVG output) and write (the direct backend as a whole).
+
+    callback:
+        type: callable
+        default: None
+        description: called as callback(phase, device, layer, seconds, counts) each time a phase is recorded
+    device:
+        type: int
+        description: the index of the device being drawn (None outside of devices)
+    layer:
+        type: int
+        description: the index of the layer being drawn within the device (None outside of layers)
+    seconds:
+        type: defaultdict
+        description: seconds keyed on (device, layer, phase)
+    counts:
+        type: defaultdict
+        description: counts keyed on (device, layer, name)
+
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.device = None
+        self.layer = None
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def add(self, phase, seconds, **counts):
+        """Record the time and counts of a phase for the current device and layer."""
+        key = (self.device, self.layer)
+        self.seconds[key + (phase,)] += seconds
+        for name, n in counts.items():
+            self.counts[key + (name,)] += n
+        if self.callback is not None:
+            self.callback(phase, self.device, self.layer, seconds, counts)
+
+    def clear(self):
+        self.device = self.layer = None
+        self.seconds.clear()
+        self.counts.clear()
+
+    def _totals(self, group):
+        totals = {}
+        for key, t in self.seconds.items():
+            entry = totals.setdefault(group(key), {})
+            entry[key[2]] = entry.get(key[2], 0.) + t
+        for key, n in self.counts.items():
+            entry = totals.setdefault(group(key), {})
+            entry[key[2]] = entry.get(key[2], 0) + n
+        return totals
+
+    def total(self):
+        """Return the seconds of each phase and the counts summed over everything."""
+        return self._totals(lambda key: None).get(None, {})
+
+    def by_device(self):
+        """Return the seconds and counts of each device (None for the schematic)."""
+        return self._totals(lambda key: key[0])
+
+    def by_layer(self):
+        """Return the seconds and counts keyed on (device index, layer index)."""
+        return self._totals(lambda key: key[:2])
+
+    def report(self):
+        """Return a table of the seconds and counts of each phase."""
+        total = self.total()
+        return '\n'.join(
+            '{:12s}{:>14}'.format(name, '%.6f s' % value if isinstance(value, float)
+                                  else value)
+            for name, value in sorted(total.items()))
+
+
 class Device:
     """A device stacks layers.
     Stacking adjusts the bounding box and the feature y-positions by a shift of the current stack height.
     If more than one layer is provided in one stack call all of the layers are placed on the same plane.
+    The stack is kept as parallel arrays, so y-positions and heights can be edited in place
+    (e.g. d.ys[-1] += thickness, or d.heights[-1] = h to clip a layer to another height)
+    and slicing a device (d[2:5]) is cheap.
 
     layers_y:
-        type: deque
-        default: empty deque
-        description: deque of 2-tuples, Layer objects at index 0 and y position at index 1
+        type: iterable
+        default: empty
+        description: 2-tuples, Layer objects at index 0 and y position at index 1, to initialize the stack with
     stack_height:
         type: float
         default: 0.
@@ -133,41 +689,207 @@ class Device:
         type: float
         default: 100.
         description: the width of the device which determines how layers stacked in the device will be clipped
+    layers:
+        type: list
+        description: the stacked Layer objects
+    ys:
+        type: array.array
+        description: the y position of each stacked layer
+    heights:
+        type: array.array
+        description: the height of each stacked layer, to which it is clipped (the layer height when it was stacked)
 
     """
 
-    def __init__(self, layers_y=deque(), stack_height=0., width=100.):
-        self.layers_y = layers_y
+    def __init__(self, layers_y=None, stack_height=0., width=100.):
+        self._layers = []
+        self._ys = array_('d')
+        self._heights = array_('d')
+        self._shared = False  # whether the arrays are shared with snapshots
+        if layers_y is not None:
+            for l, y in layers_y:
+                self._layers.append(l)
+                self._ys.append(y)
+                self._heights.append(l.height)
         self.stack_height = stack_height
         self.width = width
 
+    @classmethod
+    def _from_arrays(cls, layers, ys, heights, stack_height, width):
+        device = cls(stack_height=stack_height, width=width)
+        device._layers, device._ys, device._heights = layers, ys, heights
+        return device
+
+    def _unshare(self):
+        # copy on write: snapshots keep the arrays they were taken from
+        if self._shared:
+            self._layers = list(self._layers)
+            self._ys = self._ys[:]
+            self._heights = self._heights[:]
+            self._shared = False
+
+    @property
+    def layers(self):
+        self._unshare()
+        return self._layers
+
+    @property
+    def ys(self):
+        self._unshare()
+        return self._ys
+
+    @property
+    def heights(self):
+        self._unshare()
+        return self._heights
+
+    def __len__(self):
+        return len(self._layers)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            ys, heights = self._ys[i], self._heights[i]
+            # the top of the sliced layers, onto which further layers are stacked
+            stack_height = max(map(sum, zip(ys, heights)), default=0.)
+            return self._from_arrays(self._layers[i], ys, heights, stack_height,
+                                     self.width)
+        return self._layers[i], self._ys[i]
+
+    @property
+    def layers_y(self):
+        """deque of 2-tuples, Layer objects at index 0 and y position at index 1 (a read-only view)"""
+        return deque(zip(self._layers, self._ys))
+
+    @property
+    def layers_yh(self):
+        """deque of 3-tuples, Layer objects, their y positions and heights (a read-only view)"""
+        return deque(zip(self._layers, self._ys, self._heights))
+
     def stack(self, layers):
         if not isinstance(layers, list) and not isinstance(layers, tuple):
             layers = (layers,)
 
-        self.layers_y.extend((l, self.stack_height) for l in layers)
+        # appending leaves the prefix seen by snapshots untouched
+        for l in layers:
+            self._layers.append(l)
+            self._ys.append(self.stack_height)
+            self._heights.append(l.height)
         self.stack_height += max(layer.height for layer in layers)
 
     def pop(self, count):  # count is number of layers
+        self._unshare()
         p = deque()
-        for i in range(count - 1):
-            p.append(self.layers_y.pop())
-        pt = self.layers_y.pop()
-        self.stack_height = pt[1]
-        p.append(pt)
+        for i in range(count):
+            p.append((self._layers.pop(), self._ys.pop()))
+            self._heights.pop()
+        self.stack_height = p[-1][1]
         return p
 
-    def place(self, x, y):
-        return (l[0].place(x, y + l[1], self.width) for l in self.layers_y)
+    def place(self, x, y, batched=False, stats=None):
+        if stats is not None:
+            return _place_profiled(self._layers, self._ys, self._heights,
+                                   len(self._layers), x, y, self.width, batched,
+                                   stats)
+        return (l.place(x, y + ly, self.width, batched, height=h)
+                for l, ly, h in zip(self._layers, self._ys, self._heights))
 
     def reverse(self):
-        self.layers_y.reverse()
+        self._unshare()
+        self._layers.reverse()
+        self._ys.reverse()
+        self._heights.reverse()
 
     def copy(self):
-        layers_y = deque((l[0].copy(), l[1]) for l in self.layers_y)
-        return Device(layers_y=layers_y,
-                      stack_height=self.stack_height,
-                      width=self.width)
+        return self._from_arrays([l.copy() for l in self._layers],
+                                 self._ys[:], self._heights[:],
+                                 self.stack_height, self.width)
+
+    def snapshot(self):
+        """Return an immutable DeviceSnapshot of the current stack in O(1).
+
+        The snapshot shares the stack arrays and the Layer objects with the
+        device, so snapshots taken at each step of a process flow share the
+        common prefix of layers. Stacking onto the device afterwards only
+        appends; popping, reversing or accessing the layers, ys or heights
+        arrays first copies them (copy on write). The layers themselves are
+        not copied and should not be modified once snapshotted."""
+        self._shared = True
+        return DeviceSnapshot(self._layers, self._ys, self._heights,
+                              len(self._layers), self.stack_height, self.width)
+
+
+def _place_profiled(layers, ys, heights, n, x, y, width, batched, stats):
+    # the layer index is set while each placed layer is consumed
+    for i in range(n):
+        stats.layer = i
+        yield layers[i].place(x, y + ys[i], width, batched, stats, heights[i])
+    stats.layer = None
+
+
+class DeviceSnapshot:
+    """An immutable view of the first n layers of a device stack (see Device.snapshot).
+    It can be stacked in a Schematic like a Device.
+
+    stack_height:
+        type: float
+        description: the stack height of the device when the snapshot was taken
+    width:
+        type: float
+        description: the width of the device
+
+    """
+
+    def __init__(self, layers, ys, heights, n, stack_height, width):
+        self._layers = layers
+        self._ys = ys
+        self._heights = heights
+        self._n = n
+        self.stack_height = stack_height
+        self.width = width
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        return self.device()[i]
+
+    @property
+    def layers(self):
+        return tuple(self._layers[:self._n])
+
+    @property
+    def ys(self):
+        return tuple(self._ys[:self._n])
+
+    @property
+    def heights(self):
+        return tuple(self._heights[:self._n])
+
+    @property
+    def layers_y(self):
+        return deque(zip(self.layers, self.ys))
+
+    @property
+    def layers_yh(self):
+        return deque(zip(self.layers, self.ys, self.heights))
+
+    def place(self, x, y, batched=False, stats=None):
+        layers, ys, heights = self._layers, self._ys, self._heights
+        if stats is not None:
+            return _place_profiled(layers, ys, heights, self._n, x, y,
+                                   self.width, batched, stats)
+        return (layers[i].place(x, y + ys[i], self.width, batched, height=heights[i])
+                for i in range(self._n))
+
+    def copy(self):
+        return self
+
+    def device(self):
+        """Return a mutable Device with this stack, sharing the layers."""
+        n = self._n
+        return Device._from_arrays(self._layers[:n], self._ys[:n],
+                                   self._heights[:n], self.stack_height,
+                                   self.width)
 
 
 class Layer:
@@ -232,24 +954,84 @@ class Layer:
         if not isnan(self.period):
             self.x += self.phase_fraction * self.period
 
-    def place(self, x, y, width):
+    def visible(self, x, y, width, height=None):
+        """Return the layer bounding box in a device of the given width placed at (x, y)
+        and the x-positions of the visible instances of the feature, as an array of
+        those fully inside the bounding box and a list of those crossing it.
+        The height of the bounding box is the layer height unless given."""
 
-        bbox = Bbox(x, y, x + width, y + self.height)
+        bbox = Bbox(x, y, x + width, y + (self.height if height is None else height))
         x = self.x + x
         # if not domain relative phase shift (unlikely)
         # x = self.x + (bbox.x1 // self.period)*self.period
         # if self.x < bbox.x1 % self.period:
         #     x += self.period
+        fbbox = self.feature.get_bbox(x, y)  # the first instance
+        tol = eps * width
         if isnan(self.period):
-            feats = ((self.feature.place(x, y),), bbox, self.text)
-            return feats
-        fwidth = self.feature.width
-        # condition: i < ((1+eps)*width - fwidth - x)/self.period
-        n = ((1 + eps) * width - self.x - fwidth) / self.period
-        n = ceil(n) + 1  # plus 1 for clipping
-        feats = tuple(self.feature.place(x + i * self.period, y)
-                      for i in range(n))
-        return (feats, bbox, self.text)
+            period = 0.
+            i0 = 0
+            i1 = int(fbbox.x2 > bbox.x1 and fbbox.x1 < bbox.x2)
+            j0 = 0
+            j1 = int(fbbox.x1 >= bbox.x1 - tol and fbbox.x2 <= bbox.x2 + tol)
+        else:
+            # instance i spans fbbox.x1 + i*period to fbbox.x2 + i*period
+            period = self.period
+            i0 = max(0, floor((bbox.x1 - fbbox.x2) / period) + 1)
+            i1 = max(i0, ceil((bbox.x2 - fbbox.x1) / period))
+            j0 = ceil((bbox.x1 - tol - fbbox.x1) / period)
+            j1 = floor((bbox.x2 + tol - fbbox.x2) / period) + 1
+        if fbbox.y2 <= bbox.y1 or fbbox.y1 >= bbox.y2:
+            i1 = i0
+        if fbbox.y1 < bbox.y1 - tol or fbbox.y2 > bbox.y2 + tol:
+            j1 = j0
+        j0 = min(max(j0, i0), i1)
+        j1 = min(max(j1, j0), i1)
+        inside = x + arange(j0, j1) * period
+        crossing = [x + i * period for i in (*range(i0, j0), *range(j1, i1))]
+        return bbox, inside, crossing
+
+    def place(self, x, y, width, batched=False, stats=None, height=None):
+        """Place the instances of the feature visible in a device of the given width
+        (and clipped to the given height, by default the layer height).
+
+        Returns the placed features, the layer bounding box, the text and
+        whether the layer has to be clipped to its bounding box. Instances
+        fully inside the bounding box are placed as they are and polygon
+        instances crossing it are trimmed to it, so clipping is only needed
+        for other features crossing the bounding box."""
+
+        if stats is not None:
+            t0 = perf_counter()
+        bbox, inside, crossing = self.visible(x, y, width, height)
+        place_trimmed = getattr(self.feature, 'place_trimmed', None)
+        if self.feature.stroke_color is None:  # stroked by layer_canvas
+            place_trimmed = None
+        clip = False
+        edges = []
+        for xi in crossing:
+            if place_trimmed is None:
+                edges.append(self.feature.place(xi, y))
+                clip = True
+                continue
+            feat = place_trimmed(xi, y, bbox)
+            if feat is not None:
+                edges.append(feat)
+
+        if batched and len(inside) > 1:
+            feats = (self.feature.place_many(inside, y),)
+        else:
+            feats = tuple(self.feature.place(xi, y) for xi in inside.tolist())
+        if stats is not None:
+            stats.add('place', perf_counter() - t0,
+                      instances=len(inside) + len(edges),
+                      trimmed=0 if clip else len(crossing))
+        return (feats + tuple(edges), bbox, self.text, clip)
+
+    def key(self):
+        """Return a hashable key of the content of the layer."""
+        period = None if isnan(self.period) else self.period
+        return (self.feature.key(), period, self.x, self.height, self.text)
 
     def copy(self):
         return self.__class__(
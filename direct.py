@@ -0,0 +1,346 @@
+from numpy import array
+from features import PolygonFeature, Semicircle
+from colors import to_rgb
+from devcs import EPSStream, layer_canvas
+from pyx import unit
+
+
+def supported(layer):
+    """Whether the direct backend can draw the features of a layer."""
+    feature = layer.feature
+    return (isinstance(feature, (PolygonFeature, Semicircle)) and
+            feature.stroke_color is not None)
+
+
+def layer_shapes(layer, x, y, width, height=None):
+    """Place a layer at (x, y) in a device of the given width as plain coordinates in pt.
+
+    Returns the layer bounding box, the shapes and whether the layer has to
+    be clipped to its bounding box. Polygon shapes are lists of vertices
+    (trimmed to the bounding box where they cross it) and semicircle shapes
+    are (cx, cy, r) tuples."""
+    bbox, inside, crossing = layer.visible(x, y, width, height)
+    to_pt = unit.topt(1)
+    feature = layer.feature
+    if isinstance(feature, Semicircle):
+        r = feature.r
+        shapes = [((xi + r) * to_pt, y * to_pt, r * to_pt)
+                  for xi in inside.tolist() + crossing]
+        return bbox, shapes, bool(crossing)
+
+    coords = array(feature.coords, dtype=float)
+    verts = coords[None, :, :] + array([0., y])
+    verts = verts + inside[:, None, None] * array([1., 0.])
+    shapes = (verts * to_pt).tolist()
+    for xi in crossing:
+        points = bbox.clip_polygon([(xi + px, y + py) for px, py in coords.tolist()])
+        if len(points) >= 3:
+            shapes.append([[to_pt * px, to_pt * py] for px, py in points])
+    return bbox, shapes, False
+
+
+def shapes_bbox(shapes, semicircles):
+    """Return the bounding box in pt of placed shapes (None if there are none)."""
+    if not shapes:
+        return None
+    if semicircles:
+        return (min(cx - r for cx, cy, r in shapes), min(cy for cx, cy, r in shapes),
+                max(cx + r for cx, cy, r in shapes), max(cy + r for cx, cy, r in shapes))
+    xs = [px for shape in shapes for px, py in shape]
+    ys = [py for shape in shapes for px, py in shape]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def clipped_bbox(bbox, shapes, semicircles, clip):
+    """Return the bounding box in pt of the shapes drawn in a layer."""
+    sbbox = shapes_bbox(shapes, semicircles)
+    if sbbox is None or not clip:
+        return sbbox
+    to_pt = unit.topt(1)
+    return (max(sbbox[0], bbox.x1 * to_pt), max(sbbox[1], bbox.y1 * to_pt),
+            min(sbbox[2], bbox.x2 * to_pt), min(sbbox[3], bbox.y2 * to_pt))
+
+
+def ps_layer(layer, x, y, width, height=None):
+    """Return the PostScript drawing a layer, its bounding box and its drawn bounding box in pt."""
+    bbox, shapes, clip = layer_shapes(layer, x, y, width, height)
+    semicircles = isinstance(layer.feature, Semicircle)
+    ps, sbbox = ps_shapes(shapes, semicircles, to_rgb(layer.feature.color),
+                          bbox, clip)
+    return ps, bbox, sbbox
+
+
+def ps_shapes(shapes, semicircles, rgb, bbox, clip):
+    """Return the PostScript filling placed shapes (see layer_shapes) with an
+    (r, g, b) color and their drawn bounding box in pt."""
+    if not shapes:
+        return '', None
+    to_pt = unit.topt(1)
+    ps = ['gsave\n']
+    if clip:
+        ps.append('newpath\n%g %g moveto\n%g %g lineto\n%g %g lineto\n%g %g lineto\nclosepath\nclip\n' % (
+            bbox.x1 * to_pt, bbox.y1 * to_pt, bbox.x2 * to_pt, bbox.y1 * to_pt,
+            bbox.x2 * to_pt, bbox.y2 * to_pt, bbox.x1 * to_pt, bbox.y2 * to_pt))
+    ps.append('%f %f %f setrgbcolor\n' % tuple(rgb))
+    if semicircles:
+        for cx, cy, r in shapes:
+            ps.append('newpath\n%g %g %g 0 180 arc\n%g %g lineto\nfill\n' % (
+                cx, cy, r, cx + r, cy))
+    else:
+        for shape in shapes:
+            ps.append('newpath\n%g %g moveto\n' % tuple(shape[0]))
+            ps.extend('%g %g lineto\n' % tuple(p) for p in shape[1:])
+            ps.append('closepath\nfill\n')
+    ps.append('grestore\n')
+    return ''.join(ps), clipped_bbox(bbox, shapes, semicircles, clip)
+
+
+def layer_instances(layer, x, y, width, height=None):
+    """Place a layer at (x, y) in a device of the given width as translations of its feature.
+
+    Returns the layer bounding box, the key and the outline at the origin (in
+    pt) of the feature, the x-translations in pt of the instances drawn whole,
+    the trimmed polygon shapes (as in layer_shapes) and whether the layer has
+    to be clipped to its bounding box."""
+    bbox, inside, crossing = layer.visible(x, y, width, height)
+    to_pt = unit.topt(1)
+    feature = layer.feature
+    if isinstance(feature, Semicircle):
+        r = feature.r * to_pt
+        xs = ((inside * to_pt).tolist() + [xi * to_pt for xi in crossing])
+        return bbox, ('semicircle', r), [(0., 0., r)], xs, [], bool(crossing)
+    outline = [(px * to_pt, py * to_pt) for px, py in feature.coords.tolist()]
+    shapes = []
+    for xi in crossing:
+        points = bbox.clip_polygon([(xi + px, y + py) for px, py in feature.coords.tolist()])
+        if len(points) >= 3:
+            shapes.append([[to_pt * px, to_pt * py] for px, py in points])
+    return (bbox, ('polygon', tuple(outline)), outline, (inside * to_pt).tolist(),
+            shapes, False)
+
+
+def instances_bbox(outline, semicircles, xs, y_pt):
+    """Return the bounding box in pt of the translations xs, y_pt of an outline."""
+    if not xs:
+        return None
+    if semicircles:
+        cx, cy, r = outline[0]
+        x1, y1, x2, y2 = cx - r, cy, cx + r, cy + r
+    else:
+        x1, y1, x2, y2 = shapes_bbox([outline], False)
+    return x1 + min(xs), y1 + y_pt, x2 + max(xs), y2 + y_pt
+
+
+def union_bbox(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def ps_instanced_layer(layer, x, y, width, defs, height=None):
+    """Return the PostScript drawing a layer with a procedure per unique
+    feature, its bounding box and its drawn bounding box in pt. The
+    procedures already defined are named in defs, which is updated."""
+    bbox, key, outline, xs, shapes, clip = layer_instances(layer, x, y, width, height)
+    semicircles = key[0] == 'semicircle'
+    rgb = to_rgb(layer.feature.color)
+    ps, sbbox = ps_shapes(shapes, False, rgb, bbox, False)
+    if not xs:
+        return ps, bbox, sbbox
+    to_pt = unit.topt(1)
+    y_pt = y * to_pt
+    out = []
+    name = defs.get(key)
+    if name is None:
+        name = defs[key] = 'f%d' % len(defs)
+        if semicircles:
+            cx, cy, r = outline[0]
+            path = '%g 0 %g 0 180 arc %g 0 lineto' % (r, r, 2 * r)
+        else:
+            path = '%g %g moveto ' % outline[0] + ' '.join(
+                '%g %g lineto' % p for p in outline[1:]) + ' closepath'
+        out.append('/%s {gsave translate newpath %s fill grestore} bind def\n' % (
+            name, path))
+    out.append('gsave\n')
+    if clip:
+        out.append('newpath\n%g %g moveto\n%g %g lineto\n%g %g lineto\n%g %g lineto\nclosepath\nclip\n' % (
+            bbox.x1 * to_pt, bbox.y1 * to_pt, bbox.x2 * to_pt, bbox.y1 * to_pt,
+            bbox.x2 * to_pt, bbox.y2 * to_pt, bbox.x1 * to_pt, bbox.y2 * to_pt))
+    out.append('%f %f %f setrgbcolor\n' % tuple(rgb))
+    out.extend('%g %g %s\n' % (x_pt, y_pt, name) for x_pt in xs)
+    out.append('grestore\n')
+    ibbox = instances_bbox(outline, semicircles, xs, y_pt)
+    if clip:
+        ibbox = (max(ibbox[0], bbox.x1 * to_pt), max(ibbox[1], bbox.y1 * to_pt),
+                 min(ibbox[2], bbox.x2 * to_pt), min(ibbox[3], bbox.y2 * to_pt))
+    return ''.join(out) + ps, bbox, union_bbox(ibbox, sbbox)
+
+
+def write_eps(schematic, filename='schematic', instanced=False):
+    """Write a schematic to an EPS file, writing the PostScript of polygon and
+    semicircle features directly from their coordinates. Layer text, other
+    features and the items of the schematic canvas are drawn with pyx.
+    If instanced, each unique feature is defined once as a procedure and its
+    instances are drawn by translating and calling it."""
+    page = EPSStream()
+    page.insert(schematic.canvas)
+    if instanced:
+        defs = {}
+        # a local dictionary for the procedures, sized in the prolog once they are known
+        page.write('devcsdict begin\n')
+    for device, (xshift, yshift) in schematic.devices_xy:
+        for layer, ly, h in device.layers_yh:
+            if not supported(layer):
+                page.insert(layer_canvas(
+                    layer.place(xshift, yshift + ly, device.width, height=h)))
+                continue
+            if instanced:
+                ps, bbox, sbbox = ps_instanced_layer(layer, xshift, yshift + ly,
+                                                     device.width, defs, h)
+            else:
+                ps, bbox, sbbox = ps_layer(layer, xshift, yshift + ly, device.width, h)
+            if ps:
+                page.write(ps)
+                page.add_bbox(*sbbox)
+            if layer.text != '':
+                page.insert(layer_canvas(((), bbox, layer.text, False)))
+    if instanced:
+        page.write('end\n')
+        page.prolog.append('/devcsdict %d dict def\n' % max(1, len(defs)))
+    page.save(filename)
+
+
+def svg_layer(layer, x, y, width, clipid, height=None):
+    """Return the SVG drawing a layer and its drawn bounding box in pt."""
+    bbox, shapes, clip = layer_shapes(layer, x, y, width, height)
+    semicircles = isinstance(layer.feature, Semicircle)
+    return svg_shapes(shapes, semicircles, to_rgb(layer.feature.color), bbox,
+                      clip, clipid)
+
+
+def svg_shapes(shapes, semicircles, rgb, bbox, clip, clipid):
+    """Return the SVG filling placed shapes (see layer_shapes) with an
+    (r, g, b) color and their drawn bounding box in pt."""
+    if not shapes:
+        return '', None
+    to_pt = unit.topt(1)
+    svg = []
+    fill = 'rgb(%g%%,%g%%,%g%%)' % tuple(100 * c for c in rgb)
+    if clip:
+        svg.append('<clipPath id="%s"><rect x="%g" y="%g" width="%g" height="%g"/></clipPath>\n' % (
+            clipid, bbox.x1 * to_pt, -bbox.y2 * to_pt,
+            (bbox.x2 - bbox.x1) * to_pt, (bbox.y2 - bbox.y1) * to_pt))
+        svg.append('<g fill="%s" clip-path="url(#%s)">\n' % (fill, clipid))
+    else:
+        svg.append('<g fill="%s">\n' % fill)
+    if semicircles:
+        for cx, cy, r in shapes:
+            svg.append('<path d="M%g %gA%g %g 0 0 0 %g %gZ"/>\n' % (
+                cx + r, -cy, r, r, cx - r, -cy))
+    else:
+        for shape in shapes:
+            svg.append('<path d="M%sZ"/>\n' % 'L'.join(
+                '%g %g' % (px, -py) for px, py in shape))
+    svg.append('</g>\n')
+    return ''.join(svg), clipped_bbox(bbox, shapes, semicircles, clip)
+
+
+def svg_instanced_layer(layer, x, y, width, clipid, defs, height=None):
+    """Return the SVG drawing a layer with a <use> of a path defined once per
+    unique feature, and its drawn bounding box in pt. The paths already
+    defined are named in defs, which is updated."""
+    bbox, key, outline, xs, shapes, clip = layer_instances(layer, x, y, width, height)
+    semicircles = key[0] == 'semicircle'
+    rgb = to_rgb(layer.feature.color)
+    svg, sbbox = svg_shapes(shapes, False, rgb, bbox, False, clipid)
+    if not xs:
+        return svg, sbbox
+    to_pt = unit.topt(1)
+    y_pt = y * to_pt
+    out = []
+    name = defs.get(key)
+    if name is None:
+        name = defs[key] = 'f%d' % len(defs)
+        if semicircles:
+            cx, cy, r = outline[0]
+            d = 'M%g 0A%g %g 0 0 0 0 0Z' % (2 * r, r, r)
+        else:
+            d = 'M%sZ' % 'L'.join('%g %g' % (px, -py) for px, py in outline)
+        out.append('<defs><path id="%s" d="%s"/></defs>\n' % (name, d))
+    fill = 'rgb(%g%%,%g%%,%g%%)' % tuple(100 * c for c in rgb)
+    if clip:
+        out.append('<clipPath id="%s"><rect x="%g" y="%g" width="%g" height="%g"/></clipPath>\n' % (
+            clipid, bbox.x1 * to_pt, -bbox.y2 * to_pt,
+            (bbox.x2 - bbox.x1) * to_pt, (bbox.y2 - bbox.y1) * to_pt))
+        out.append('<g fill="%s" clip-path="url(#%s)">\n' % (fill, clipid))
+    else:
+        out.append('<g fill="%s">\n' % fill)
+    out.extend('<use xlink:href="#%s" x="%g" y="%g"/>\n' % (name, x_pt, -y_pt)
+               for x_pt in xs)
+    out.append('</g>\n')
+    ibbox = instances_bbox(outline, semicircles, xs, y_pt)
+    if clip:
+        ibbox = (max(ibbox[0], bbox.x1 * to_pt), max(ibbox[1], bbox.y1 * to_pt),
+                 min(ibbox[2], bbox.x2 * to_pt), min(ibbox[3], bbox.y2 * to_pt))
+    return ''.join(out) + svg, union_bbox(ibbox, sbbox)
+
+
+def write_svg(schematic, filename='schematic', instanced=False):
+    """Write a schematic to an SVG file directly from the feature coordinates.
+    Schematics with layer text, other features or items on the schematic
+    canvas are written with pyx instead. If instanced, each unique feature
+    is defined once and its instances are drawn with <use>."""
+    if not filename.endswith('.svg'):
+        filename += '.svg'
+    if schematic.canvas.items or any(
+            layer.text != '' or not supported(layer)
+            for device, shift in schematic.devices_xy
+            for layer, ly in device.layers_y):
+        return schematic.write(filename, format='svg')
+
+    body = []
+    defs = {}
+    for device, (xshift, yshift) in schematic.devices_xy:
+        for layer, ly, h in device.layers_yh:
+            if instanced:
+                svg, sbbox = svg_instanced_layer(layer, xshift, yshift + ly,
+                                                 device.width, 'c%d' % len(body),
+                                                 defs, h)
+            else:
+                svg, sbbox = svg_layer(layer, xshift, yshift + ly, device.width,
+                                       'c%d' % len(body), h)
+            if svg:
+                body.append((svg, sbbox))
+    save_svg(filename, body, xlink=instanced)
+
+
+def save_svg(filename, body, xlink=False):
+    """Write an SVG file from the (svg, drawn bounding box) of each drawn layer."""
+    llx = lly = float('inf')
+    urx = ury = float('-inf')
+    for svg, sbbox in body:
+        llx, lly = min(llx, sbbox[0]), min(lly, sbbox[1])
+        urx, ury = max(urx, sbbox[2]), max(ury, sbbox[3])
+    if not body:
+        llx = lly = urx = ury = 0.
+    # enlarge by 1pt as pyx does
+    llx, lly, urx, ury = llx - 1, lly - 1, urx + 1, ury + 1
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        f.write('<svg xmlns="http://www.w3.org/2000/svg" version="1.1" ')
+        if xlink:
+            f.write('xmlns:xlink="http://www.w3.org/1999/xlink" ')
+        f.write('width="%gpt" height="%gpt" viewBox="%g %g %g %g">\n' % (
+                urx - llx, ury - lly, llx, -ury, urx - llx, ury - lly))
+        f.writelines(svg for svg, sbbox in body)
+        f.write('</svg>\n')
+
+
+def write_direct(schematic, filename='schematic', format='eps', instanced=False):
+    if format == 'eps':
+        return write_eps(schematic, filename, instanced)
+    if format == 'svg':
+        return write_svg(schematic, filename, instanced)
+    raise ValueError('unknown format %r' % format)
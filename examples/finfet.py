@@ -74,12 +74,8 @@ p = Layer(x0=35, feature=Rectangle(30, 20, color=dc['p-type']))
 
 d2 = Device()
 d2.stack(substrate)
-#d2.stack([substrate_oxide, fin, n1, n2, p, fin_contacts])
-#d2.layers_y[-1][1] += oxide_thickness
-# tuple implementation does not allow reassignment
-d2.stack([substrate_oxide, fin, n1, n2, p])
-d2.stack_height += oxide_thickness - 20  # 20 is fin height from oxide to oxide
-d2.stack(fin_contacts)
+d2.stack([substrate_oxide, fin, n1, n2, p, fin_contacts])
+d2.ys[-1] += oxide_thickness  # contacts sit on the substrate oxide
 d2.stack_height -= oxide_thickness
 d2.stack(fin_oxide)
 d2.stack(fin_gate)
@@ -10,11 +10,11 @@ gate = Layer(x0=40, feature=Rectangle(20, 1, color=dc['gate']))
 d = Device()
 s = Schematic(xsep=1.25 * d.width, ysep=40, wrap=2)
 d.stack(substrate)
-s.stack(d.copy())
+s.stack(d.snapshot())
 d.stack((n, p))
-s.stack(d.copy())
+s.stack(d.snapshot())
 d.stack(oxide)
-s.stack(d.copy())
+s.stack(d.snapshot())
 d.stack(gate)
-s.stack(d.copy())
+s.stack(d.snapshot())
 s.write('mosfet')
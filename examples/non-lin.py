@@ -1,5 +1,5 @@
 from devcs import *
-from pyx import color as pyxcolor
+from colors import rgb
 from convfuncs import num2period_half
 
 s = Schematic()
@@ -8,7 +8,7 @@ f = Semicircle(3)
 p, x0 = num2period_half(10, f.width, d.width)
 l = Layer(period=p, feature=f, x0=x0, height=1)
 f, x0a = f.magnify(0.05)
-f.color = f.stroke_color = pyxcolor.rgb.red
+f = f.with_color(rgb.red, rgb.red)
 l2 = Layer(feature=f, period=p, x0=x0 + x0a, height=1)
 
 d.stack((l2, l))
@@ -0,0 +1,29 @@
+from devcs import *
+from features import *
+from convfuncs import num2period, spacingsreqs
+from sweep import Sweep
+from time import time
+
+t0 = time()
+sw = Sweep(dwidth=(100, 147), num=(2, 4, 8), spacing=(5, 10))
+# periods and offsets for every point at once
+sw.grid['period'] = num2period(sw.grid['num'], 5, sw.grid['dwidth'])
+sw.grid['rtub_period'], sw.grid['rtub_x0'] = spacingsreqs(6, sw.grid['spacing'],
+                                                          sw.grid['dwidth'])
+
+
+def build(dwidth, num, spacing, period, rtub_period, rtub_x0):
+    d = Device(width=dwidth)
+    d.stack(sw.layer(period=period, feature=sw.feature(Square, 5)))
+    d.stack(sw.layer(period=rtub_period, x0=rtub_x0,
+                     feature=sw.feature(RightTriangleUpBack, 6, 3)))
+    d.stack(sw.layer(feature=sw.feature(Rectangle, dwidth, 1)))
+    s = Schematic()
+    s.stack(d)
+    return s
+
+
+for r in sw.write(build, 'sweep'):
+    if r.error:
+        print(r.filename, r.error)
+print(len(sw), time() - t0)
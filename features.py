@@ -1,6 +1,7 @@
-from pyx import path, color as pyxcolor
-from numpy import sqrt, arctan2, array, roll
-from numpy.linalg import norm
+from numpy import sqrt, array, asarray, zeros, pi
+from math import atan2
+from weakref import WeakValueDictionary
+from colors import rgb, color_key, to_pyx
 
 
 class Bbox():
@@ -9,13 +10,25 @@ class Bbox():
     y1 is the y-coordinate of the lower left corner (the minimum y)
     x2 is the x-coordinate of the upper right corner (the maximum x)
     y2 is the y-coordinate of the upper right corner (the maximum y)
+    Bounding boxes are immutable.
     """
 
+    __slots__ = ('x1', 'y1', 'x2', 'y2')
+
     def __init__(self, x1, y1, x2, y2):
-        self.x1 = x1
-        self.y1 = y1
-        self.x2 = x2
-        self.y2 = y2
+        set_ = object.__setattr__
+        set_(self, 'x1', x1)
+        set_(self, 'y1', y1)
+        set_(self, 'x2', x2)
+        set_(self, 'y2', y2)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Bbox is immutable')
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return (Bbox, (self.x1, self.y1, self.x2, self.y2))
 
     def __getitem__(self, i):
         if i == 0:
@@ -29,20 +42,39 @@ class Bbox():
         else:
             raise IndexError("Out of range")
 
-    def __setitem__(self, i, v):
-        if i == 0:
-            self.x1 = v
-        elif i == 1:
-            self.y1 = v
-        elif i == 2:
-            self.x2 = v
-        elif i == 3:
-            self.y2 = v
-
     def __str__(self):
         return '{} {} {} {}'.format(self.x1, self.y1, self.x2, self.y2)
 
+    def translated(self, x, y):
+        """Return the bounding box shifted by (x, y)."""
+        return Bbox(self.x1 + x, self.y1 + y, self.x2 + x, self.y2 + y)
+
+    def clip_polygon(self, points):
+        """Clip the polygon with the given vertices to the bounding box
+        (Sutherland-Hodgman). Returns the vertices of the clipped polygon."""
+        for axis, bound, sign in ((0, self.x1, 1), (0, self.x2, -1),
+                                  (1, self.y1, 1), (1, self.y2, -1)):
+            if not points:
+                break
+            clipped = []
+            prev = points[-1]
+            prev_in = sign * (prev[axis] - bound) >= 0
+            for cur in points:
+                cur_in = sign * (cur[axis] - bound) >= 0
+                if cur_in != prev_in:
+                    t = (bound - prev[axis]) / (cur[axis] - prev[axis])
+                    cross = [prev[0] + t * (cur[0] - prev[0]),
+                             prev[1] + t * (cur[1] - prev[1])]
+                    cross[axis] = bound
+                    clipped.append(tuple(cross))
+                if cur_in:
+                    clipped.append(cur)
+                prev, prev_in = cur, cur_in
+            points = clipped
+        return points
+
     def to_path(self):
+        from pyx import path
         return path.rect(
             self.x1,
             self.y1,
@@ -52,102 +84,233 @@ class Bbox():
             self.y1)
 
 
-class PolygonFeature():
-    """Superclass for all polygon features regular and irregular."""
+def polygon_path(points):
+    """Return the closed path through the given vertices in pt."""
+    from pyx import path
+    return path.path(path.moveto_pt(*points[0]),
+                     path.multilineto_pt(points[1:]),
+                     path.closepath())
+
+
+class _Interned(type):
+    """Metaclass of the features: creating a feature equal in content (see key)
+    to one which still exists returns that one, so equal features are shared."""
+
+    def __call__(cls, *args, **kwargs):
+        feature = super().__call__(*args, **kwargs)
+        return cls._interned.setdefault(feature.key(), feature)
+
+
+def _rebuild(cls, args, kwargs):
+    # unpickled features are interned as well
+    return cls(*args, **kwargs)
+
+
+class PolygonFeature(metaclass=_Interned):
+    """Superclass for all polygon features regular and irregular.
+
+    Features are immutable (use with_color for a recolored copy) and equal
+    features are the same object. The coordinates are kept as a read-only
+    NumPy array and the width, height, bounding box at the origin, centroid
+    and phase angle order are computed when the feature is created. The
+    outline at the origin is cached as a template (in pt) so that placing an
+    instance only applies a translation. pyx is only imported once a feature
+    is placed.
+
+    coords:
+        type: numpy.ndarray
+        description: the (n, 2) vertices, read-only
+    char_dims:
+        type: tuple
+        description: the characteristic dimensions the feature was made with
+    width:
+        type: float
+        description: the x-extent of the coordinates
+    height:
+        type: float
+        description: the y-extent of the coordinates
+    bbox:
+        type: Bbox
+        description: the bounding box of the coordinates
+    centroid:
+        type: tuple
+        description: the mean of the vertices
+    order:
+        type: tuple
+        description: the vertex indices by decreasing phase angle about the centroid
 
-    def __init__(self, color=pyxcolor.rgb.black, stroke_color=None, coords=[]):
-        self.color = color
-        self.stroke_color = stroke_color
+    """
+
+    __slots__ = ('coords', 'char_dims', 'color', 'stroke_color', 'width', 'height',
+                 'bbox', 'centroid', 'order', '_points', '_key', '_template',
+                 '__weakref__')
+    _interned = WeakValueDictionary()
+
+    def __init__(self, color=rgb.black, stroke_color=None, coords=(), char_dims=None):
+        set_ = object.__setattr__
+        points = tuple((float(px), float(py)) for px, py in coords)
+        coords = array(points, dtype=float).reshape(-1, 2)
+        coords.flags.writeable = False
+        set_(self, 'coords', coords)
+        set_(self, 'char_dims', char_dims)
+        set_(self, 'color', color)
+        set_(self, 'stroke_color', stroke_color)
+        set_(self, '_points', points)
+        if points:
+            xs, ys = zip(*points)
+            x1, y1, x2, y2 = min(xs), min(ys), max(xs), max(ys)
+            centroid = (sum(xs) / len(xs), sum(ys) / len(ys))
+        else:
+            x1 = y1 = x2 = y2 = 0.
+            centroid = (0., 0.)
+        phis = [atan2(py - centroid[1], px - centroid[0]) for px, py in points]
+        order = tuple(sorted(range(len(points)), key=lambda i: -phis[i]))
+        set_(self, 'width', x2 - x1)
+        set_(self, 'height', y2 - y1)
+        set_(self, 'bbox', Bbox(x1, y1, x2, y2))
+        set_(self, 'centroid', centroid)
+        set_(self, 'order', order)
+        set_(self, '_key', (type(self).__name__, points,
+                            color_key(color), color_key(stroke_color)))
+        set_(self, '_template', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('features are immutable, use with_color for other colors')
+
+    __delattr__ = __setattr__
+
+    def _args(self):
+        """Return the positional and keyword arguments which make the feature."""
+        kwargs = dict(color=self.color, stroke_color=self.stroke_color)
+        if type(self) is PolygonFeature:
+            kwargs.update(coords=self._points, char_dims=self.char_dims)
+            return (), kwargs
+        return self.char_dims, kwargs
+
+    def __reduce__(self):
+        args, kwargs = self._args()
+        return (_rebuild, (type(self), args, kwargs))
+
+    def key(self):
+        """Return a hashable key of the geometry and colors of the feature."""
+        return self._key
+
+    def with_color(self, color=None, stroke_color=None):
+        """Return the feature with another fill and/or stroke color."""
+        args, kwargs = self._args()
+        if color is not None:
+            kwargs['color'] = color
+        if stroke_color is not None:
+            kwargs['stroke_color'] = stroke_color
+        return type(self)(*args, **kwargs)
 
     def sort_coords(self):
-        """Sort coordinates by phase angle, which gives a drawing order for convex polygons."""
-        phis = []
-        xp, yp = zip(*self.coords)
-        cop = (sum(xp) / len(xp), sum(yp) / len(yp))
-        for point in self.coords:
-            phis.append(arctan2(point[1] - cop[1], point[0] - cop[0]))
-        s, s_phis = zip(*sorted(zip(self.coords, phis), key=lambda x: -x[1]))
-        self.coords = s
+        """Return a ConvexPolygon of the coordinates sorted by phase angle, which
+        gives a drawing order for convex polygons."""
+        return ConvexPolygon(self.coords[list(self.order)], self.color, self.stroke_color)
+
+    def template(self):
+        """Return the vertices in pt at the origin and the colors, built once."""
+        if self._template is None:
+            from pyx import unit
+            to_pt = unit.topt(1)
+            points = tuple((to_pt * px, to_pt * py) for px, py in self._points)
+            object.__setattr__(self, '_template',
+                               (points, to_pyx(self.color), to_pyx(self.stroke_color)))
+        return self._template
 
     def place(self, x, y):
-        x0, y0 = self.coords[0]
-        paths = [path.moveto(x + x0, y + y0)]
-        for point in self.coords[1:]:
-            paths.append(path.lineto(x + point[0], y + point[1]))
-        paths.append(path.closepath())
-        return (path.path(*paths), self.color, self.stroke_color)
+        from pyx import unit
+        points, color, stroke_color = self.template()
+        x, y = unit.topt(x), unit.topt(y)
+        points = [(x + px, y + py) for px, py in points]
+        return (polygon_path(points), color, stroke_color)
+
+    def place_trimmed(self, x, y, bbox):
+        """Place the feature trimmed to bbox, or return None if nothing of it is inside."""
+        points = bbox.clip_polygon([(x + px, y + py) for px, py in self._points])
+        if len(points) < 3:
+            return None
+        from pyx import unit
+        _, color, stroke_color = self.template()
+        to_pt = unit.topt(1)
+        points = [(to_pt * px, to_pt * py) for px, py in points]
+        return (polygon_path(points), color, stroke_color)
+
+    def place_many(self, xs, y):
+        """Place an instance at each x in xs as one compound path.
+        The vertices of all instances are computed as a single array."""
+        from pyx import path, unit
+        points, color, stroke_color = self.template()
+        offsets = zeros((len(xs), 1, 2))
+        offsets[:, 0, 0] = xs
+        offsets[:, 0, 1] = y
+        verts = array(points) + offsets * unit.topt(1)
+        m = verts.shape[1]
+        verts = verts.reshape(-1, 2)
+        points = list(zip(verts[:, 0].tolist(), verts[:, 1].tolist()))
+        paths = []
+        for i in range(0, len(points), m):
+            paths.append(path.moveto_pt(*points[i]))
+            paths.append(path.multilineto_pt(points[i + 1:i + m]))
+            paths.append(path.closepath())
+        return (path.path(*paths), color, stroke_color)
 
     def get_bbox(self, x, y):
-        """Return bbox based off the subclass coordinates."""
-        xc, yc = zip(*self.coords)
-        bbox = Bbox(min(xc) + x, min(yc) + y, max(xc) + x, max(yc) + y)
-        return bbox
-
-    # have these appear to be attributes when they are actually calculated by a getter function
-    @property
-    def width(self):
-        xc, _ = zip(*self.coords)
-        return max(xc) - min(xc)
-
-    @property
-    def height(self):
-        _, yc = zip(*self.coords)
-        return max(yc) - min(yc)
+        """Return the bounding box of the feature placed at (x, y)."""
+        return self.bbox.translated(x, y)
 
     def copy(self):
-        d = self.__dict__
-        dims = d['char_dims']
-        dv = {'color':d['color'],'stroke_color':d['stroke_color']}
-        return self.__class__(*dims,**dv)
+        # features are immutable, so copies share the feature
+        return self
 
 
 class Square(PolygonFeature):
-    def __init__(self, a, color=pyxcolor.rgb.black,
-                 stroke_color=pyxcolor.rgb.black):
-        super().__init__(color=color, stroke_color=stroke_color)
-        self.char_dims = (a,)
-        self.coords = [(0, 0), (a, 0), (a, a), (0, a)]
+    __slots__ = ()
+
+    def __init__(self, a, color=rgb.black,
+                 stroke_color=rgb.black):
+        super().__init__(color, stroke_color, [(0, 0), (a, 0), (a, a), (0, a)], (a,))
 
 
 class Rectangle(PolygonFeature):
-    def __init__(self, w, h, color=pyxcolor.rgb.black,
-                 stroke_color=pyxcolor.rgb.black):
-        super().__init__(color=color, stroke_color=stroke_color)
-        self.char_dims = (w, h)
-        self.coords = [(0, 0), (w, 0), (w, h), (0, h)]
+    __slots__ = ()
+
+    def __init__(self, w, h, color=rgb.black,
+                 stroke_color=rgb.black):
+        super().__init__(color, stroke_color, [(0, 0), (w, 0), (w, h), (0, h)], (w, h))
 
 
 class RightTriangleUpBack(PolygonFeature):
-    def __init__(self, a, b, color=pyxcolor.rgb.black,
-                 stroke_color=pyxcolor.rgb.black):
-        super().__init__(color=color, stroke_color=stroke_color)
-        self.char_dims = (a, b)
-        self.coords = [(0, 0), (a, 0), (0, b)]
+    __slots__ = ()
+
+    def __init__(self, a, b, color=rgb.black,
+                 stroke_color=rgb.black):
+        super().__init__(color, stroke_color, [(0, 0), (a, 0), (0, b)], (a, b))
 
 
 class RightTriangleUpForward(PolygonFeature):
-    def __init__(self, a, b, color=pyxcolor.rgb.black,
-                 stroke_color=pyxcolor.rgb.black):
-        super().__init__(color=color, stroke_color=stroke_color)
-        self.char_dims = (a, b)
-        self.coords = [(0, 0), (a, 0), (a, b)]
+    __slots__ = ()
+
+    def __init__(self, a, b, color=rgb.black,
+                 stroke_color=rgb.black):
+        super().__init__(color, stroke_color, [(0, 0), (a, 0), (a, b)], (a, b))
 
 
 class RightTriangleDownForward(PolygonFeature):
-    def __init__(self, a, b, color=pyxcolor.rgb.black,
-                 stroke_color=pyxcolor.rgb.black):
-        super().__init__(color=color, stroke_color=stroke_color)
-        self.char_dims = (a, b)
-        self.coords = [(a, 0), (a, b), (0, b)]
+    __slots__ = ()
+
+    def __init__(self, a, b, color=rgb.black,
+                 stroke_color=rgb.black):
+        super().__init__(color, stroke_color, [(a, 0), (a, b), (0, b)], (a, b))
 
 
 class RightTriangleDownBack(PolygonFeature):
-    def __init__(self, a, b, color=pyxcolor.rgb.black,
-                 stroke_color=pyxcolor.rgb.black):
-        super().__init__(color=color, stroke_color=stroke_color)
-        self.char_dims = (a, b)
-        self.coords = [(0, 0), (a, b), (0, b)
-                       ]
+    __slots__ = ()
+
+    def __init__(self, a, b, color=rgb.black,
+                 stroke_color=rgb.black):
+        super().__init__(color, stroke_color, [(0, 0), (a, b), (0, b)], (a, b))
 
 # all possibilities:
 #- (0,0), (a,0), (0,b)
@@ -157,52 +320,103 @@ class RightTriangleDownBack(PolygonFeature):
 
 
 class EquilateralTriangle(PolygonFeature):
-    def __init__(self, a, color=pyxcolor.rgb.black,
-                 stroke_color=pyxcolor.rgb.black):
-        super().__init__(color=color, stroke_color=stroke_color)
-        self.char_dims = (a,)
-        self.coords = [(0, 0), (a / 2, a * sqrt(3) / 2), (a, 0)]
+    __slots__ = ()
+
+    def __init__(self, a, color=rgb.black,
+                 stroke_color=rgb.black):
+        super().__init__(color, stroke_color,
+                         [(0, 0), (a / 2, a * sqrt(3) / 2), (a, 0)], (a,))
 
 
 class ConvexPolygon(PolygonFeature):
+    """A convex polygon; its coordinates are sorted by phase angle."""
+    __slots__ = ()
+
     def __init__(
             self,
             coords,
-            color=pyxcolor.rgb.black,
-            stroke_color=pyxcolor.rgb.black):
-        super().__init__(color=color, stroke_color=stroke_color)
-        self.char_dims = coords
-        self.coords = coords
-        self.sort_coords()
-    def copy(self):
-        return self.__class__(self.coords,self.color,self.stroke_color)
+            color=rgb.black,
+            stroke_color=rgb.black):
+        points = [(float(px), float(py)) for px, py in coords]
+        xs, ys = zip(*points)
+        xc, yc = sum(xs) / len(xs), sum(ys) / len(ys)
+        coords = sorted(points, key=lambda p: -atan2(p[1] - yc, p[0] - xc))
+        super().__init__(color, stroke_color, coords)
+        object.__setattr__(self, 'char_dims', self._points)
+
+    def _args(self):
+        return ((self._points,), dict(color=self.color, stroke_color=self.stroke_color))
 
 # non-linear
 
 
-class Semicircle():
-    def __init__(self, diameter, color=pyxcolor.rgb.black, stroke_color=None):
-        self.color = color
-        self.stroke_color = stroke_color
-        if self.stroke_color is None:
-            self.stroke_color = self.color
-
-        self.r = diameter / 2.
+class Semicircle(metaclass=_Interned):
+    """A semicircle with its flat side down. Like polygon features it is
+    immutable and interned, and the outline at the origin is cached as a
+    template."""
+
+    __slots__ = ('r', 'color', 'stroke_color', 'width', 'height', 'bbox', 'centroid',
+                 '_key', '_template', '__weakref__')
+    _interned = WeakValueDictionary()
+
+    def __init__(self, diameter, color=rgb.black, stroke_color=None):
+        set_ = object.__setattr__
+        if stroke_color is None:
+            stroke_color = color
+        r = diameter / 2.
+        set_(self, 'r', r)
+        set_(self, 'color', color)
+        set_(self, 'stroke_color', stroke_color)
+        set_(self, 'width', 2 * r)
+        set_(self, 'height', r)
+        set_(self, 'bbox', Bbox(0, 0, 2 * r, r))
+        set_(self, 'centroid', (r, 4 * r / (3 * pi)))
+        set_(self, '_key', (type(self).__name__, float(r),
+                            color_key(color), color_key(stroke_color)))
+        set_(self, '_template', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('features are immutable, use with_color for other colors')
+
+    __delattr__ = __setattr__
+
+    def _args(self):
+        return ((2 * self.r,), dict(color=self.color, stroke_color=self.stroke_color))
+
+    __reduce__ = PolygonFeature.__reduce__
+    with_color = PolygonFeature.with_color
+
+    def key(self):
+        """Return a hashable key of the geometry and colors of the feature."""
+        return self._key
+
+    def template(self):
+        """Return the radius in pt and the colors, built once."""
+        if self._template is None:
+            from pyx import unit
+            object.__setattr__(self, '_template', (unit.topt(self.r), to_pyx(self.color),
+                                                   to_pyx(self.stroke_color)))
+        return self._template
 
     def place(self, x, y):
-        return (path.path(
-            path.arc(
-                x +
-                self.r,
-                y,
-                self.r,
-                0,
-                180),
-            path.lineto(
-                x +
-                2 *
-                self.r,
-                y)), self.color, self.stroke_color)
+        from pyx import path, unit
+        r_pt, color, stroke_color = self.template()
+        x, y = unit.topt(x), unit.topt(y)
+        return (path.path(path.arc_pt(x + r_pt, y, r_pt, 0, 180),
+                          path.lineto_pt(x + 2 * r_pt, y)),
+                color, stroke_color)
+
+    def place_many(self, xs, y):
+        """Place an instance at each x in xs as one compound path."""
+        from pyx import path, unit
+        r_pt, color, stroke_color = self.template()
+        y_pt = unit.topt(y)
+        paths = []
+        for x_pt in (asarray(xs, dtype=float) * unit.topt(1)).tolist():
+            paths.append(path.moveto_pt(x_pt + 2 * r_pt, y_pt))
+            paths.append(path.arc_pt(x_pt + r_pt, y_pt, r_pt, 0, 180))
+            paths.append(path.closepath())
+        return (path.path(*paths), color, stroke_color)
 
     def get_bbox(self, x, y):
         return Bbox(x, y, x + 2 * self.r, y + self.r)
@@ -222,4 +436,4 @@ class Semicircle():
                                                         magnification) * self.r
 
     def copy(self):
-        return Semicircle(self.r * 2., self.color, self.stroke_color)
+        return self
@@ -0,0 +1,500 @@
+from numpy import (array, asarray, concatenate, cumsum, empty, ndarray, pad,
+                   searchsorted, zeros)
+from features import Bbox, Semicircle, polygon_path
+from colors import color_key, to_rgb
+
+POLYGON = 0
+SEMICIRCLE = 1
+
+_columns = ('vertices', 'offsets', 'kinds', 'radii', 'fills', 'strokes',
+            'layer_offsets', 'bboxes', 'clips', 'label_index', 'devices',
+            'colors', 'labels')
+
+
+class PlacedGeometry:
+    """A placed schematic as flat NumPy columns, independent of the renderer.
+
+    A primitive is a filled polygon or semicircle and a layer is a run of
+    consecutive primitives with a bounding box, a clip flag and a label. The
+    columns are plain arrays, so a PlacedGeometry pickles cheaply, can be
+    saved with save/load, shared between processes without copying with
+    to_shared/from_shared, and drawn with pyx (canvases, write) or the
+    direct backend (write with backend='direct').
+
+    vertices:
+        type: numpy.ndarray
+        description: (V, 2) polygon vertices and semicircle centres in pt
+    offsets:
+        type: numpy.ndarray
+        description: (P + 1,) start of each primitive in vertices followed by V
+    kinds:
+        type: numpy.ndarray
+        description: (P,) POLYGON or SEMICIRCLE
+    radii:
+        type: numpy.ndarray
+        description: (P,) semicircle radius in pt (0. for polygons)
+    fills:
+        type: numpy.ndarray
+        description: (P,) index of the fill color in colors
+    strokes:
+        type: numpy.ndarray
+        description: (P,) index of the stroke color in colors (-1 for no stroke color)
+    layer_offsets:
+        type: numpy.ndarray
+        description: (L + 1,) start of each layer in the primitives followed by P
+    bboxes:
+        type: numpy.ndarray
+        description: (L, 4) layer bounding boxes (x1, y1, x2, y2) in the placement units
+    clips:
+        type: numpy.ndarray
+        description: (L,) whether each layer has to be clipped to its bounding box
+    label_index:
+        type: numpy.ndarray
+        description: (L,) index of the layer text in labels (-1 for no text)
+    devices:
+        type: numpy.ndarray
+        description: (L,) index of the device of each layer
+    colors:
+        type: numpy.ndarray
+        description: (C, 3) table of the (r, g, b) colors
+    labels:
+        type: numpy.ndarray
+        description: (T,) table of the unique layer texts
+
+    """
+
+    def __init__(self, **columns):
+        for name in _columns:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        return len(self.kinds)
+
+    @property
+    def nlayers(self):
+        return len(self.clips)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in _columns)
+
+    def arrays(self):
+        """Return the columns as a dict of arrays."""
+        return {name: getattr(self, name) for name in _columns}
+
+    @classmethod
+    def from_schematic(cls, schematic, x=0., y=0.):
+        """Place the devices of a schematic shifted by (x, y).
+        The primitives of each layer are those of Layer.place."""
+        from direct import layer_shapes, supported
+        from pyx import unit
+        to_pt = unit.topt(1)
+        colors = {}
+        labels = {}
+
+        def color_index(c):
+            if c is None:
+                return -1
+            return colors.setdefault(color_key(c), (len(colors), to_rgb(c)))[0]
+
+        vertices, counts, kinds, radii, fills, strokes = [], [], [], [], [], []
+        layer_counts, bboxes, clips, label_index, devices = [], [], [], [], []
+        for i, (device, (xshift, yshift)) in enumerate(schematic.devices_xy):
+            for layer, ly, h in device.layers_yh:
+                x0, y0 = x + xshift, y + yshift + ly
+                feature = layer.feature
+                if supported(layer):
+                    bbox, shapes, clip = layer_shapes(layer, x0, y0, device.width, h)
+                else:
+                    # features without a stroke color are placed whole and clipped
+                    bbox, inside, crossing = layer.visible(x0, y0, device.width, h)
+                    coords = array(feature.coords, dtype=float)
+                    xs = inside.tolist() + crossing
+                    shapes = [((coords + (xi, y0)) * to_pt).tolist() for xi in xs]
+                    clip = bool(crossing)
+                semicircles = isinstance(feature, Semicircle)
+                if semicircles:
+                    vertices.extend((cx, cy) for cx, cy, r in shapes)
+                    counts.extend(1 for s in shapes)
+                    radii.extend(r for cx, cy, r in shapes)
+                else:
+                    for shape in shapes:
+                        vertices.extend(shape)
+                        counts.append(len(shape))
+                    radii.extend(0. for s in shapes)
+                kinds.extend((SEMICIRCLE if semicircles else POLYGON) for s in shapes)
+                fills.extend(color_index(feature.color) for s in shapes)
+                strokes.extend(color_index(feature.stroke_color) for s in shapes)
+                layer_counts.append(len(shapes))
+                bboxes.append((bbox.x1, bbox.y1, bbox.x2, bbox.y2))
+                clips.append(clip)
+                label_index.append(-1 if layer.text == '' else
+                                   labels.setdefault(layer.text, len(labels)))
+                devices.append(i)
+
+        offsets = zeros(len(counts) + 1, dtype=int)
+        cumsum(counts, out=offsets[1:])
+        layer_offsets = zeros(len(layer_counts) + 1, dtype=int)
+        cumsum(layer_counts, out=layer_offsets[1:])
+        table = empty((len(colors), 3))
+        for index, rgb in colors.values():
+            table[index] = rgb
+        return cls(vertices=array(vertices, dtype=float).reshape(-1, 2),
+                   offsets=offsets,
+                   kinds=array(kinds, dtype='u1'),
+                   radii=array(radii, dtype=float),
+                   fills=array(fills, dtype='i4'),
+                   strokes=array(strokes, dtype='i4'),
+                   layer_offsets=layer_offsets,
+                   bboxes=array(bboxes, dtype=float).reshape(-1, 4),
+                   clips=array(clips, dtype=bool),
+                   label_index=array(label_index, dtype='i4'),
+                   devices=array(devices, dtype='i4'),
+                   colors=table,
+                   labels=array(list(labels), dtype=str))
+
+    def layer(self, l):
+        """Return the bounding box, shapes (as in direct.layer_shapes), whether
+        they are semicircles, the fill color index, the clip flag and the text
+        of layer l."""
+        p0, p1 = self.layer_offsets[l], self.layer_offsets[l + 1]
+        bbox = Bbox(*self.bboxes[l].tolist())
+        clip = bool(self.clips[l])
+        text = '' if self.label_index[l] < 0 else str(self.labels[self.label_index[l]])
+        if p0 == p1:
+            return bbox, [], False, -1, clip, text
+        semicircles = self.kinds[p0] == SEMICIRCLE
+        offsets = self.offsets[p0:p1 + 1].tolist()
+        if semicircles:
+            shapes = [tuple(v) + (r,) for v, r in zip(
+                self.vertices[offsets[0]:offsets[-1]].tolist(),
+                self.radii[p0:p1].tolist())]
+        else:
+            points = self.vertices[offsets[0]:offsets[-1]].tolist()
+            o = offsets[0]
+            shapes = [points[i - o:j - o] for i, j in zip(offsets[:-1], offsets[1:])]
+        return bbox, shapes, semicircles, int(self.fills[p0]), clip, text
+
+    def merged(self, tol=1e-6):
+        """Return a copy in which abutting or overlapping axis-aligned rectangles
+        of the same colors in a device are merged into single outlines.
+
+        Rectangles in layers which are clipped, or whose text extends past
+        their bounding box so that layer_canvas clips them, are left alone
+        (a merged outline is drawn in the layer of its first rectangle and
+        would be cut by its clip). A rectangle is
+        merged into the earliest group of its colors in its device that it
+        shares an edge with or overlaps, as long as nothing of another color
+        (or a layer text) drawn in between overlaps it, so the drawing order
+        is kept. The outline of a group takes the place of its first
+        rectangle. Groups whose union has a hole are not merged. Coordinates
+        closer than tol (in pt) are taken to be equal."""
+        nprim = len(self)
+        offsets = self.offsets.tolist()
+        vertices = self.vertices
+        layer_of = zeros(nprim, dtype=int)
+        for l in range(self.nlayers):
+            layer_of[self.layer_offsets[l]:self.layer_offsets[l + 1]] = l
+        # primitive bounding boxes
+        pboxes = empty((nprim, 4))
+        for p in range(nprim):
+            v = vertices[offsets[p]:offsets[p + 1]]
+            if self.kinds[p] == SEMICIRCLE:
+                (cx, cy), r = v[0], self.radii[p]
+                pboxes[p] = cx - r, cy, cx + r, cy + r
+            else:
+                pboxes[p] = v[:, 0].min(), v[:, 1].min(), v[:, 0].max(), v[:, 1].max()
+        from devcs import label_overflows
+        clipped = [bool(self.clips[l]) or (
+            self.label_index[l] >= 0 and
+            label_overflows(str(self.labels[self.label_index[l]]),
+                            Bbox(*self.bboxes[l].tolist())))
+            for l in range(self.nlayers)]
+        rect = [self.kinds[p] == POLYGON and not clipped[layer_of[p]] and
+                is_rectangle(vertices[offsets[p]:offsets[p + 1]], tol)
+                for p in range(nprim)]
+
+        from pyx import unit
+        from spatial import GridIndex
+        to_pt = unit.topt(1)
+        colors = list(zip(self.fills.tolist(), self.strokes.tolist()))
+        groups = {}  # first primitive of a group -> members
+        member_of = {}
+        # the layers of each device are contiguous in the devices column
+        devices = self.devices
+        for d in sorted(set(devices.tolist())):
+            l0, l1 = searchsorted(devices, d), searchsorted(devices, d, 'right')
+            # draw order of the device: primitives, then the text of each layer
+            order = []
+            for l in range(l0, l1):
+                order.extend(range(self.layer_offsets[l], self.layer_offsets[l + 1]))
+                if self.label_index[l] >= 0:
+                    order.append(-1 - l)
+            position = {item: k for k, item in enumerate(order)}
+            # items near a rectangle are found by position in a grid of their boxes
+            index = GridIndex([self._item_box(q, pboxes, to_pt) for q in order])
+            for k, p in enumerate(order):
+                if p < 0 or not rect[p]:
+                    continue
+                box = pboxes[p]
+                near = [order[n] for n in index.query(box[0] - tol, box[1] - tol,
+                                                      box[2] + tol, box[3] + tol).tolist()
+                        if n < k]
+                # groups with an earlier rectangle of the same colors sharing an
+                # edge with or overlapping this one, the earliest group first
+                candidates = sorted({member_of[q] for q in near
+                                     if q >= 0 and q in member_of and
+                                     colors[q] == colors[p] and
+                                     touching(pboxes[q], box, tol)},
+                                    key=position.get)
+                # items of other colors or text drawn after a group would be covered
+                blocking = [position[q] for q in near
+                            if (q < 0 or colors[q] != colors[p]) and
+                            overlapping(self._item_box(q, pboxes, to_pt), box, tol)]
+                for first in candidates:
+                    if any(n > position[first] for n in blocking):
+                        continue
+                    groups[first].append(p)
+                    member_of[p] = first
+                    break
+                else:
+                    groups[p] = [p]
+                    member_of[p] = p
+
+        outlines = {}
+        for first, members in groups.items():
+            if len(members) < 2:
+                continue
+            outline = union_rectangles(pboxes[members], tol)
+            if outline is not None:
+                outlines[first] = outline
+                for m in members:
+                    member_of[m] = first
+        merged_away = {m for first in outlines for m in groups[first] if m != first}
+
+        new_vertices, counts, keep = [], [], []
+        layer_counts = []
+        for l in range(self.nlayers):
+            n = 0
+            for p in range(self.layer_offsets[l], self.layer_offsets[l + 1]):
+                if p in merged_away:
+                    continue
+                shape = outlines.get(p)
+                if shape is None:
+                    shape = vertices[offsets[p]:offsets[p + 1]]
+                new_vertices.append(shape)
+                counts.append(len(shape))
+                keep.append(p)
+                n += 1
+            layer_counts.append(n)
+        new_offsets = zeros(len(counts) + 1, dtype=int)
+        cumsum(counts, out=new_offsets[1:])
+        layer_offsets = zeros(len(layer_counts) + 1, dtype=int)
+        cumsum(layer_counts, out=layer_offsets[1:])
+        columns = self.arrays()
+        columns.update(
+            vertices=(concatenate(new_vertices) if new_vertices
+                      else empty((0, 2))).astype(float),
+            offsets=new_offsets,
+            kinds=self.kinds[keep], radii=self.radii[keep],
+            fills=self.fills[keep], strokes=self.strokes[keep],
+            layer_offsets=layer_offsets)
+        return self.__class__(**columns)
+
+    def _item_box(self, q, pboxes, to_pt):
+        # bounding box in pt of a primitive, or of the layer -1 - q for its text
+        if q >= 0:
+            return pboxes[q]
+        return self.bboxes[-1 - q] * to_pt
+
+    def canvases(self):
+        """Yield the pyx canvas of each layer as Schematic.write draws it."""
+        from pyx import path, color as pyxcolor
+        from devcs import layer_canvas
+        colors = [pyxcolor.rgb(*rgb) for rgb in self.colors.tolist()]
+        for l in range(self.nlayers):
+            bbox, shapes, semicircles, fill, clip, text = self.layer(l)
+            p0 = self.layer_offsets[l]
+            strokes = [None if s < 0 else colors[s]
+                       for s in self.strokes[p0:p0 + len(shapes)].tolist()]
+            if semicircles:
+                feats = tuple((path.path(path.arc_pt(cx, cy, r, 0, 180),
+                                         path.lineto_pt(cx + r, cy)),
+                               colors[fill], stroke)
+                              for (cx, cy, r), stroke in zip(shapes, strokes))
+            else:
+                feats = tuple((polygon_path([tuple(p) for p in shape]),
+                               colors[fill], stroke)
+                              for shape, stroke in zip(shapes, strokes))
+            yield layer_canvas((feats, bbox, text, clip))
+
+    def write(self, filename='schematic', format='eps', backend='pyx', canvas=None):
+        """Write the geometry to an EPS or SVG file with the pyx or direct backend.
+        The items of a pyx canvas (e.g. Schematic.canvas) are drawn first. The
+        direct backend writes SVG with pyx if there is text or a canvas."""
+        if format not in ('eps', 'svg'):
+            raise ValueError('unknown format %r' % format)
+        if backend == 'direct':
+            return self._write_direct(filename, format, canvas)
+        if backend != 'pyx':
+            raise ValueError('unknown backend %r' % backend)
+        from pyx import canvas as pyxcanvas
+        c = pyxcanvas.canvas()
+        if canvas is not None:
+            c.insert(canvas)
+        for laycanv in self.canvases():
+            c.insert(laycanv)
+        if format == 'svg':
+            c.writeSVGfile(filename)
+        else:
+            c.writeEPSfile(filename)
+
+    def _write_direct(self, filename, format, canvas):
+        from direct import ps_shapes, svg_shapes, save_svg
+        from devcs import EPSStream, layer_canvas
+        colors = [tuple(rgb) for rgb in self.colors.tolist()]
+        if format == 'svg':
+            if not filename.endswith('.svg'):
+                filename += '.svg'
+            if (canvas is not None and canvas.items) or len(self.labels):
+                return self.write(filename, format='svg', canvas=canvas)
+            body = []
+            for l in range(self.nlayers):
+                bbox, shapes, semicircles, fill, clip, text = self.layer(l)
+                if shapes:
+                    body.append(svg_shapes(shapes, semicircles, colors[fill], bbox,
+                                           clip, 'c%d' % len(body)))
+            return save_svg(filename, body)
+
+        page = EPSStream()
+        if canvas is not None:
+            page.insert(canvas)
+        for l in range(self.nlayers):
+            bbox, shapes, semicircles, fill, clip, text = self.layer(l)
+            if shapes:
+                ps, sbbox = ps_shapes(shapes, semicircles, colors[fill], bbox, clip)
+                page.write(ps)
+                page.add_bbox(*sbbox)
+            if text != '':
+                page.insert(layer_canvas(((), bbox, text, False)))
+        page.save(filename)
+
+    def save(self, file):
+        """Save the columns to an uncompressed .npz file."""
+        from numpy import savez
+        savez(file, **self.arrays())
+
+    @classmethod
+    def load(cls, file):
+        from numpy import load
+        with load(file) as columns:
+            return cls(**{name: columns[name] for name in _columns})
+
+    def to_shared(self):
+        """Copy the columns into one block of shared memory.
+
+        Returns the SharedMemory, which the caller has to close and unlink
+        once done, and a picklable spec with which other processes attach
+        to the columns without copying them (see from_shared)."""
+        from multiprocessing.shared_memory import SharedMemory
+        layout = []
+        size = 0
+        for name in _columns:
+            a = asarray(getattr(self, name))
+            layout.append((name, a.dtype.str, a.shape, size))
+            size += -(-a.nbytes // 8) * 8  # keep each column 8 byte aligned
+        shm = SharedMemory(create=True, size=max(size, 1))
+        for name, dtype, shape, offset in layout:
+            a = getattr(self, name)
+            ndarray(shape, dtype, buffer=shm.buf, offset=offset)[...] = a
+        return shm, (shm.name, layout)
+
+    @classmethod
+    def from_shared(cls, spec):
+        """Attach to columns in shared memory (see to_shared).
+        Returns the PlacedGeometry, whose columns are views of the shared
+        memory, and the SharedMemory, which has to be kept open while they are used."""
+        from multiprocessing.shared_memory import SharedMemory
+        name, layout = spec
+        shm = SharedMemory(name=name)
+        columns = {column: ndarray(shape, dtype, buffer=shm.buf, offset=offset)
+                   for column, dtype, shape, offset in layout}
+        return cls(**columns), shm
+
+
+def is_rectangle(vertices, tol):
+    """Whether a polygon is a rectangle with sides parallel to the axes."""
+    if len(vertices) != 4:
+        return False
+    xs, ys = vertices[:, 0], vertices[:, 1]
+    # each side is either horizontal or vertical, alternately
+    dx = abs(xs - xs[[1, 2, 3, 0]]) <= tol
+    dy = abs(ys - ys[[1, 2, 3, 0]]) <= tol
+    return bool((dx == ~dy).all() and dx[0] != dx[1] and
+                xs.max() - xs.min() > tol and ys.max() - ys.min() > tol)
+
+
+def overlapping(a, b, tol):
+    """Whether two bounding boxes (x1, y1, x2, y2) overlap with a positive area."""
+    return (min(a[2], b[2]) - max(a[0], b[0]) > tol and
+            min(a[3], b[3]) - max(a[1], b[1]) > tol)
+
+
+def touching(a, b, tol):
+    """Whether two bounding boxes overlap or share a piece of an edge."""
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    return w >= -tol and h >= -tol and (w > tol or h > tol)
+
+
+def snap(values, tol):
+    """Return the sorted distinct values, taking values closer than tol to be equal."""
+    values = sorted(values)
+    distinct = [values[0]]
+    for v in values[1:]:
+        if v - distinct[-1] > tol:
+            distinct.append(v)
+    return array(distinct)
+
+
+def union_rectangles(boxes, tol):
+    """Return the outline of the union of rectangles (x1, y1, x2, y2) as an
+    (n, 2) array of counterclockwise vertices, or None if the union is not
+    a single region without holes.
+
+    The rectangles are rasterized on the grid of their distinct coordinates
+    and the boundary between covered and uncovered cells is traced."""
+    xs = snap(boxes[:, [0, 2]].ravel(), tol)
+    ys = snap(boxes[:, [1, 3]].ravel(), tol)
+    covered = zeros((len(xs) - 1, len(ys) - 1), dtype=bool)
+    i = searchsorted(xs, boxes[:, [0, 2]] - tol)
+    j = searchsorted(ys, boxes[:, [1, 3]] - tol)
+    for (i0, i1), (j0, j1) in zip(i.tolist(), j.tolist()):
+        covered[i0:i1, j0:j1] = True
+    c = pad(covered, 1)
+    inner = c[1:-1, 1:-1]
+    # directed edges between grid points with the covered cell on the left
+    edges = {}
+    for mask, (di0, dj0, di1, dj1) in (
+            (inner & ~c[1:-1, :-2], (0, 0, 1, 0)),  # bottom
+            (inner & ~c[2:, 1:-1], (1, 0, 1, 1)),  # right
+            (inner & ~c[1:-1, 2:], (1, 1, 0, 1)),  # top
+            (inner & ~c[:-2, 1:-1], (0, 1, 0, 0))):  # left
+        for ci, cj in zip(*mask.nonzero()):
+            start = (int(ci) + di0, int(cj) + dj0)
+            if start in edges:  # two regions meet at a corner
+                return None
+            edges[start] = (int(ci) + di1, int(cj) + dj1)
+    start = min(edges)
+    loop = [start]
+    point = edges[start]
+    while point != start:
+        loop.append(point)
+        point = edges[point]
+    if len(loop) != len(edges):  # holes or separate regions
+        return None
+    # drop the grid points along straight sides
+    n = len(loop)
+    corners = [loop[k] for k in range(n)
+               if (loop[k - 1][0] == loop[k][0]) != (loop[k][0] == loop[(k + 1) % n][0])]
+    return array([(xs[ci], ys[cj]) for ci, cj in corners])
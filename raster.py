@@ -0,0 +1,174 @@
+"""Rasterize placed geometry (see geometry.PlacedGeometry) with NumPy and write PNG files.
+
+Polygons are filled with an even-odd scanline fill at the pixel centres,
+vectorized over all edges of all polygons at once, and drawn in order, so a
+later polygon covers an earlier one. Semicircles are drawn as polygons and
+coverage is antialiased by supersampling. Outlines (stroke colors), layer text
+and the items of the schematic canvas are not drawn.
+"""
+import struct
+import zlib
+from numpy import (arange, array, ceil, clip, concatenate, cos, empty, frexp,
+                   full, int32, lexsort, linspace, maximum, minimum, pi, repeat,
+                   sin, uint8, uint16, uint32, zeros)
+from geometry import SEMICIRCLE
+
+arc_segments = 32  # straight segments per semicircle
+
+
+def rasterize(geometry, dpi=72, supersample=2, background=(1., 1., 1.), margin=1.):
+    """Return an RGB image (uint8 array of height x width x 3) of placed geometry.
+
+    dpi sets the scale (72 dpi is 1 pixel per pt), supersample the number of
+    samples per pixel along each axis (at most 16) and margin the border in pt."""
+    if supersample != int(supersample) or not 1 <= supersample <= 16:
+        # the samples of a pixel are summed in 16 bits: 16 * 16 * 255 < 2**16
+        raise ValueError('supersample must be an integer from 1 to 16')
+    supersample = int(supersample)
+    owner, x0, y0, x1, y1, npoly = _edges(geometry)
+    scale = dpi / 72. * supersample
+    if len(x0):
+        llx = min(x0.min(), x1.min()) - margin
+        lly = min(y0.min(), y1.min()) - margin
+        urx = max(x0.max(), x1.max()) + margin
+        ury = max(y0.max(), y1.max()) + margin
+    else:
+        llx = lly = 0.
+        urx = ury = 2 * margin
+    width = max(1, int(ceil((urx - llx) * dpi / 72.)))
+    height = max(1, int(ceil((ury - lly) * dpi / 72.)))
+    w, h = width * supersample, height * supersample
+    # to sample coordinates, with y downwards
+    x0, x1 = (x0 - llx) * scale, (x1 - llx) * scale
+    y0, y1 = (ury - y0) * scale, (ury - y1) * scale
+
+    # the clip box of each primitive in sample coordinates
+    from pyx import unit
+    counts = geometry.layer_offsets[1:] - geometry.layer_offsets[:-1]
+    layer_of = repeat(arange(len(counts)), counts)
+    cx0 = zeros(npoly)
+    cx1 = full(npoly, float(w))
+    cy0 = zeros(npoly)
+    cy1 = full(npoly, float(h))
+    clipped = geometry.clips[layer_of]
+    if clipped.any():
+        b = geometry.bboxes[layer_of[clipped]] * unit.topt(1)
+        cx0[clipped] = (b[:, 0] - llx) * scale
+        cx1[clipped] = (b[:, 2] - llx) * scale
+        cy0[clipped] = (ury - b[:, 3]) * scale
+        cy1[clipped] = (ury - b[:, 1]) * scale
+
+    # rows whose centre lies in [ymin, ymax) of each edge
+    ymin, ymax = minimum(y0, y1), maximum(y0, y1)
+    r0 = clip(ceil(ymin - 0.5), 0, h).astype(int)
+    r1 = clip(ceil(ymax - 0.5), 0, h).astype(int)
+    n = r1 - r0
+    e = repeat(arange(len(n)), n)
+    rows = r0[e] + arange(n.sum()) - repeat(n.cumsum() - n, n)
+    yc = rows + 0.5
+    t = (yc - y0[e]) / (y1[e] - y0[e])
+    xc = x0[e] + t * (x1[e] - x0[e])
+    poly = owner[e]
+    # pair the crossings of each polygon and row (even-odd rule)
+    order = lexsort((xc, rows, poly))
+    poly, rows, xc = poly[order], rows[order], xc[order]
+    poly, rows, xa, xb = poly[::2], rows[::2], xc[::2], xc[1::2]
+    inside = (rows + 0.5 >= cy0[poly]) & (rows + 0.5 < cy1[poly])
+    poly, rows, xa, xb = poly[inside], rows[inside], xa[inside], xb[inside]
+    xa = clip(ceil(maximum(xa, cx0[poly]) - 0.5), 0, w).astype(int)
+    xb = clip(ceil(minimum(xb, cx1[poly]) - 0.5), 0, w).astype(int)
+    n = xb - xa
+    poly, rows, xa, xb, n = poly[n > 0], rows[n > 0], xa[n > 0], xb[n > 0], n[n > 0]
+    # keep the last primitive drawn on each sample: a span of length n is
+    # covered by two blocks of length 2**k <= n, which are marked at level k
+    # and then split into halves down to single samples (level 0)
+    k = frexp(n)[1] - 1
+    starts = rows * w + xa
+    poly = poly.astype(int32)
+    top = full(w * h, -1, dtype=int32)
+    spare = empty(w * h, dtype=int32)
+    for level in range(k.max() if len(k) else 0, -1, -1):
+        if level < k.max():
+            half = 1 << level
+            spare[:half] = top[:half]
+            maximum(top[half:], top[:-half], out=spare[half:])
+            top, spare = spare, top
+        at = k == level
+        maximum.at(top, starts[at], poly[at])
+        maximum.at(top, starts[at] + n[at] - (1 << level), poly[at])
+
+    palette = concatenate((geometry.colors.reshape(-1, 3)[geometry.fills],
+                           array([background], dtype=float)))
+    # pack each color into 4 bytes so that the lookup is a single take
+    palette = (palette * 255 + 0.5).astype(uint32)
+    palette = palette[:, 0] | palette[:, 1] << 8 | palette[:, 2] << 16
+    image = palette.astype('<u4').take(top).view(uint8).reshape(h, w, 4)[:, :, :3]
+    if supersample == 1:
+        return image.copy()  # index -1 above is the background
+    # average the samples of each pixel
+    total = zeros((height, width, 3), dtype=uint16)
+    for i in range(supersample):
+        for j in range(supersample):
+            total += image[i::supersample, j::supersample]
+    n = supersample * supersample
+    return ((total + n // 2) // n).astype(uint8)
+
+
+def _edges(geometry):
+    """Return the primitive of each non-horizontal edge, the edge end points in
+    pt and the number of primitives; semicircles are replaced by polygons."""
+    nprim = len(geometry)
+    offsets = geometry.offsets
+    counts = offsets[1:] - offsets[:-1]
+    verts = geometry.vertices
+    semicircles = (geometry.kinds == SEMICIRCLE).nonzero()[0]
+    if len(semicircles):
+        # replace the centre of each semicircle by the vertices of its outline
+        old_starts = offsets[:-1]
+        counts = counts.copy()
+        counts[semicircles] = arc_segments + 1
+        starts = concatenate(([0], counts.cumsum()[:-1]))
+        owner = repeat(arange(nprim), counts)
+        moved = empty((counts.sum(), 2))
+        old_owner = repeat(arange(nprim), offsets[1:] - old_starts)
+        polygon = geometry.kinds[old_owner] != SEMICIRCLE
+        i = arange(len(verts))[polygon]
+        moved[starts[old_owner[i]] + i - old_starts[old_owner[i]]] = verts[i]
+        t = linspace(0, pi, arc_segments + 1)
+        r = geometry.radii[semicircles][:, None]
+        centres = verts[old_starts[semicircles]]
+        j = (starts[semicircles][:, None] + arange(arc_segments + 1)).ravel()
+        moved[j, 0] = (centres[:, :1] + r * cos(t)).ravel()
+        moved[j, 1] = (centres[:, 1:] + r * sin(t)).ravel()
+        verts = moved
+    else:
+        owner = repeat(arange(nprim), counts)
+    starts = concatenate(([0], counts.cumsum()[:-1])) if nprim else zeros(0, int)
+    # the next vertex of each vertex, wrapping around within its polygon
+    nxt = arange(len(owner)) + 1
+    last = starts + counts - 1
+    nxt[last[counts > 0]] = starts[counts > 0]
+    x0, y0 = verts[:, 0], verts[:, 1]
+    x1, y1 = verts[nxt, 0], verts[nxt, 1]
+    horizontal = y0 == y1
+    return (owner[~horizontal], x0[~horizontal], y0[~horizontal],
+            x1[~horizontal], y1[~horizontal], nprim)
+
+
+def write_png(filename, image):
+    """Write an RGB image (uint8 array of height x width x 3) to a PNG file."""
+    if not filename.endswith('.png'):
+        filename += '.png'
+    height, width = image.shape[:2]
+    raw = zeros((height, width * 3 + 1), dtype=uint8)  # filter type 0 per row
+    raw[:, 1:] = image.reshape(height, width * 3)
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
@@ -0,0 +1,317 @@
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil
+from os import cpu_count
+from time import perf_counter
+from traceback import format_exc
+from devcs import layer_canvas
+
+RenderResult = namedtuple('RenderResult', ('filename', 'seconds', 'error'))
+RenderResult.__doc__ = """Outcome of one render job.
+
+filename:
+    type: str
+    description: the filename passed to Schematic.write
+seconds:
+    type: float
+    description: wall time spent placing and writing the schematic
+error:
+    type: str or None
+    description: the formatted traceback if the job failed, else None
+"""
+
+
+def render_one(schematic, filename, **kwargs):
+    """Write one schematic, returning a RenderResult instead of raising."""
+    t0 = perf_counter()
+    try:
+        schematic.write(filename, **kwargs)
+    except Exception:
+        return RenderResult(filename, perf_counter() - t0, format_exc())
+    return RenderResult(filename, perf_counter() - t0, None)
+
+
+def render_many(jobs, workers=None, **kwargs):
+    """Write many schematics over a process pool.
+
+    jobs is an iterable of (schematic, filename) pairs. The schematics are
+    pickled to the worker processes, which place and serialize them with
+    Schematic.write (keyword arguments are passed on to it). A failing job,
+    including one which cannot be pickled, is reported in its RenderResult
+    and does not stop the rest of the batch. Results are in job order.
+    With workers=1 the jobs are rendered serially in this process.
+    """
+    jobs = list(jobs)
+    if workers == 1:
+        return [render_one(s, f, **kwargs) for s, f in jobs]
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(render_one, s, f, **kwargs) for s, f in jobs]
+        for (s, f), future in zip(jobs, futures):
+            try:
+                results.append(future.result())
+            except Exception:
+                results.append(RenderResult(f, 0., format_exc()))
+    return results
+
+
+LayerGeometry = namedtuple('LayerGeometry', (
+    'kind', 'vertices', 'offsets', 'radius', 'color', 'bbox', 'text', 'clip'))
+LayerGeometry.__doc__ = """Placed geometry of one layer as plain arrays (see place_devices).
+
+kind:
+    type: str
+    description: 'polygon' or 'semicircle'
+vertices:
+    type: numpy.ndarray
+    description: (n, 2) polygon vertices, or semicircle centres, in pt
+offsets:
+    type: numpy.ndarray or None
+    description: start of each polygon in vertices followed by the number of vertices (None for semicircles)
+radius:
+    type: float
+    description: the semicircle radius in pt (0. for polygons)
+color:
+    type: tuple
+    description: the (r, g, b) fill color
+bbox:
+    type: tuple
+    description: the layer bounding box (x1, y1, x2, y2)
+text:
+    type: str
+    description: the layer text
+clip:
+    type: bool
+    description: whether the layer has to be clipped to its bounding box
+"""
+
+
+def place_geometry(device, x, y):
+    """Place a device at (x, y) as a list of LayerGeometry, with None for the
+    layers whose features cannot be expressed as plain arrays."""
+    from numpy import array, cumsum, zeros
+    from direct import supported, layer_shapes
+    from colors import to_rgb
+    from features import Semicircle
+    from pyx import unit
+    geometry = []
+    for layer, ly, h in device.layers_yh:
+        if not supported(layer):
+            geometry.append(None)
+            continue
+        bbox, shapes, clip = layer_shapes(layer, x, y + ly, device.width, h)
+        color = to_rgb(layer.feature.color)
+        bbox = (bbox.x1, bbox.y1, bbox.x2, bbox.y2)
+        if isinstance(layer.feature, Semicircle):
+            vertices = array([(cx, cy) for cx, cy, r in shapes],
+                             dtype=float).reshape(-1, 2)
+            geometry.append(LayerGeometry('semicircle', vertices, None,
+                                          unit.topt(layer.feature.r), color,
+                                          bbox, layer.text, clip))
+            continue
+        offsets = zeros(len(shapes) + 1, dtype=int)
+        cumsum([len(shape) for shape in shapes], out=offsets[1:])
+        vertices = array([p for shape in shapes for p in shape],
+                         dtype=float).reshape(-1, 2)
+        geometry.append(LayerGeometry('polygon', vertices, offsets, 0., color,
+                                      bbox, layer.text, clip))
+    return geometry
+
+
+def _place_chunk(chunk):
+    return [place_geometry(device, x, y) for device, (x, y) in chunk]
+
+
+def device_fragments(device, x, y):
+    """Serialize the layers of a device placed at (x, y) to PostScript (see
+    direct.ps_layer), as a list of (ps, bbox, drawn bbox) tuples with None for
+    the layers whose features cannot be written directly."""
+    from direct import supported, ps_layer
+    return [ps_layer(layer, x, y + ly, device.width, h) if supported(layer) else None
+            for layer, ly, h in device.layers_yh]
+
+
+def _serialize_chunk(chunk):
+    return [device_fragments(device, x, y) for device, (x, y) in chunk]
+
+
+def map_devices(fn, schematic, workers=None, chunksize=None):
+    """Apply fn to chunks of the (device, (x, y)) pairs of a schematic over a
+    process pool and return its results for each device in order. With
+    workers=1 the devices are processed in this process."""
+    devices_xy = list(schematic.devices_xy)
+    if workers == 1:
+        return fn(devices_xy)
+    if chunksize is None:
+        chunksize = max(1, len(devices_xy) // (4 * (workers or cpu_count())))
+    chunks = [devices_xy[i:i + chunksize]
+              for i in range(0, len(devices_xy), chunksize)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return [result for results in pool.map(fn, chunks) for result in results]
+
+
+def place_devices(schematic, workers=None, chunksize=None):
+    """Place the devices of a schematic over a process pool.
+
+    The devices are sent to the workers in chunks, and each worker returns the
+    placed geometry of its devices as lists of LayerGeometry, which pickle as
+    plain arrays rather than pyx objects. Returns a list with the geometry of
+    each device in order. With workers=1 the devices are placed in this process.
+    """
+    return map_devices(_place_chunk, schematic, workers, chunksize)
+
+
+def serialize_devices(schematic, page, workers=None):
+    """Write the devices of a schematic to an EPSStream, serializing their
+    layers over a process pool (see device_fragments). This process only
+    appends the PostScript of the workers to the page and draws the layer
+    text and the layers that cannot be written directly."""
+    serialized = map_devices(_serialize_chunk, schematic, workers)
+    for (device, (x, y)), fragments in zip(schematic.devices_xy, serialized):
+        for (layer, ly, h), fragment in zip(device.layers_yh, fragments):
+            if fragment is None:
+                page.insert(layer_canvas(layer.place(x, y + ly, device.width, height=h)))
+                continue
+            ps, bbox, sbbox = fragment
+            if ps:
+                page.write(ps)
+                page.add_bbox(*sbbox)
+            if layer.text != '':
+                page.insert(layer_canvas(((), bbox, layer.text, False)))
+
+
+def write_serialized(schematic, filename='schematic', workers=None):
+    """Write a schematic to an EPS file as the direct backend does, serializing
+    the devices over a process pool (see serialize_devices)."""
+    from devcs import EPSStream
+    page = EPSStream()
+    page.insert(schematic.canvas)
+    serialize_devices(schematic, page, workers)
+    page.save(filename)
+
+
+def geometry_canvas(geometry):
+    """Draw the LayerGeometry of a layer on a canvas (see devcs.layer_canvas)."""
+    from pyx import path, color as pyxcolor
+    from features import Bbox, polygon_path
+    color = pyxcolor.rgb(*geometry.color)
+    points = geometry.vertices.tolist()
+    if geometry.kind == 'semicircle':
+        r = geometry.radius
+        feats = tuple((path.path(path.arc_pt(cx, cy, r, 0, 180),
+                                 path.lineto_pt(cx + r, cy)), color, color)
+                      for cx, cy in points)
+    else:
+        offsets = geometry.offsets.tolist()
+        feats = tuple((polygon_path([tuple(p) for p in points[i:j]]), color, color)
+                      for i, j in zip(offsets[:-1], offsets[1:]))
+    return layer_canvas((feats, Bbox(*geometry.bbox), geometry.text, geometry.clip))
+
+
+def placed_canvases(schematic, workers=None, batched=False):
+    """Yield the layer canvases of each device of a schematic, placing the
+    devices over a process pool (see place_devices). Layers that cannot be
+    placed as plain arrays are placed in this process."""
+    placed = place_devices(schematic, workers)
+    for (device, (x, y)), geometry in zip(schematic.devices_xy, placed):
+        laycanvs = []
+        for (layer, ly, h), g in zip(device.layers_yh, geometry):
+            if g is None:
+                laycanvs.append(layer_canvas(
+                    layer.place(x, y + ly, device.width, batched, height=h)))
+            else:
+                laycanvs.append(geometry_canvas(g))
+        yield laycanvs
+
+
+def shard_bboxes(schematic, tile=None):
+    """Split a schematic into shards, as (column, row, Bbox, device indices) tuples.
+
+    Without a tile each column of devices (see Schematic.stack) is a shard
+    bounded by its devices. With tile=(width, height) the layout is cut into
+    tiles of that size from the lower left corner of the schematic, leaving
+    out the tiles without any layer. A tile only holds the devices that
+    overlap it with a positive area."""
+    from features import Bbox
+    from geometry import overlapping
+    index = schematic.index()
+    boxes = index.devices.boxes
+    if not len(boxes):
+        return []
+    if tile is None:
+        columns = {}
+        for d, (device, (xshift, yshift)) in enumerate(schematic.devices_xy):
+            columns.setdefault(xshift, []).append(d)
+        shards = []
+        for column, xshift in enumerate(sorted(columns)):
+            own = boxes[columns[xshift]]
+            shards.append((column, 0, Bbox(own[:, 0].min(), own[:, 1].min(),
+                                           own[:, 2].max(), own[:, 3].max()),
+                           columns[xshift]))
+        return shards
+    width, height = tile
+    x1, y1 = boxes[:, 0].min(), boxes[:, 1].min()
+    x2, y2 = boxes[:, 2].max(), boxes[:, 3].max()
+    shards = []
+    for column in range(max(1, int(ceil((x2 - x1) / width)))):
+        for row in range(max(1, int(ceil((y2 - y1) / height)))):
+            bbox = Bbox(x1 + column * width, y1 + row * height,
+                        x1 + (column + 1) * width, y1 + (row + 1) * height)
+            # boxes which only touch a tile edge would be clipped away entirely
+            if any(overlapping(box, bbox, 0.)
+                   for box in index.layers.boxes[index.layers.query(*bbox)].tolist()):
+                devices = [d for d in index.devices_overlapping(bbox)
+                           if overlapping(boxes[d].tolist(), bbox, 0.)]
+                shards.append((column, row, bbox, devices))
+    return shards
+
+
+def _write_shard(job):
+    schematic, bbox, filename, format, batched = job
+    schematic.index().write(filename, bbox, format, batched, frame=True)
+    return filename
+
+
+def write_shards(schematic, filename='schematic', tile=None, format='eps',
+                 workers=None, batched=False):
+    """Write a schematic as shards (see shard_bboxes) over a process pool.
+
+    Each shard is written to its own file, filename_<column>_<row>.<format>,
+    with only the devices overlapping it, clipped to its bounding box. All
+    shards keep the coordinates of the whole schematic and their page is their
+    bounding box, so placing the files at their bounding boxes reassembles the
+    layout. The shards and their bounding boxes (in the schematic units and in
+    pt) are recorded in the index file filename.json, which is also returned
+    as a dict. With workers=1 the shards are written in this process."""
+    import json
+    import os
+    from pyx import unit
+    if format not in ('eps', 'svg'):
+        raise ValueError('unknown format %r' % format)
+    to_pt = unit.topt(1)
+    devices_xy = list(schematic.devices_xy)
+    shards = shard_bboxes(schematic, tile)
+    jobs = []
+    for column, row, bbox, devices in shards:
+        part = schematic.__class__(wrap=schematic.wrap, ysep=schematic.ysep,
+                                   xsep=schematic.xsep,
+                                   devices_xy=deque(devices_xy[d] for d in devices),
+                                   canvas=schematic._canvas)
+        jobs.append((part, bbox, '%s_%d_%d.%s' % (filename, column, row, format),
+                     format, batched))
+    if workers == 1:
+        files = [_write_shard(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            files = list(pool.map(_write_shard, jobs))
+    index = dict(format=format,
+                 tile=None if tile is None else list(tile),
+                 shards=[dict(file=os.path.basename(f), column=column, row=row,
+                              bbox=[float(v) for v in bbox],
+                              bbox_pt=[float(v) * to_pt for v in bbox],
+                              devices=devices)
+                         for f, (column, row, bbox, devices) in zip(files, shards)])
+    with open(filename + '.json', 'w') as f:
+        json.dump(index, f, indent=1)
+    return index
@@ -0,0 +1,277 @@
+"""A long-running render server which keeps pyx, NumPy and the text engine loaded.
+
+Clients send pickled schematics with the filename and keyword arguments of
+Schematic.write and get back the path of the written file, so many short
+rendering jobs pay the startup cost once. The server listens on a Unix socket,
+serving each connection in a forked copy of the warm process, or talks over
+its stdin and stdout:
+
+    python server.py --socket /tmp/devcs.sock
+    python server.py --stdio
+
+Client connects to a server (or starts one over stdin/stdout) and sends it
+the work. Setting the environment variable DEVCS_RENDER_SERVER to the socket
+path makes Schematic.write in existing scripts send their work to the server,
+falling back to writing it in the script with a warning if the server is down.
+Errors raised by the server are raised again in the client with their type.
+Messages are pickles, so the server must only be reachable by trusted local
+users (the socket is created readable and writable by its owner only).
+"""
+import argparse
+import os
+import pickle
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import warnings
+from time import perf_counter
+
+env_var = 'DEVCS_RENDER_SERVER'
+_header = struct.Struct('>Q')
+
+
+class ServerUnavailable(ConnectionError):
+    """The render server cannot be reached or closed the connection."""
+
+
+class RemoteTraceback(Exception):
+    """The traceback of an error raised on the render server, set as the cause
+    of the error raised again by the client."""
+
+    def __init__(self, tb):
+        self.tb = tb
+
+    def __str__(self):
+        return self.tb
+
+
+def send_message(f, obj):
+    """Write a length-prefixed pickle to a binary file."""
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    f.write(_header.pack(len(data)) + data)
+    f.flush()
+
+
+def recv_message(f):
+    """Read a length-prefixed pickle from a binary file, or None at the end of the file."""
+    header = f.read(_header.size)
+    if len(header) < _header.size:
+        return None
+    (n,) = _header.unpack(header)
+    data = f.read(n)
+    if len(data) < n:
+        return None
+    return data
+
+
+def output_path(filename, format='eps'):
+    """Return the path Schematic.write writes filename to."""
+    suffix = '.' + format
+    return filename if filename.endswith(suffix) else filename + suffix
+
+
+def handle(data):
+    """Write the schematic of a request with Schematic.write and return the response."""
+    from traceback import format_exc
+    t0 = perf_counter()
+    try:
+        request = pickle.loads(data)
+        filename = os.path.join(request.get('cwd', ''), request['filename'])
+        kwargs = request.get('kwargs', {})
+        request['schematic'].write(filename, **kwargs)
+    except Exception as e:
+        try:  # so that the client raises it again with its type
+            exception = pickle.dumps(e, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            exception = None
+        return dict(path=None, seconds=perf_counter() - t0, error=format_exc(),
+                    exception=exception)
+    return dict(path=os.path.abspath(output_path(filename, kwargs.get('format', 'eps'))),
+                seconds=perf_counter() - t0, error=None)
+
+
+def serve(rfile, wfile):
+    """Answer the requests read from rfile on wfile until the end of rfile."""
+    while True:
+        data = recv_message(rfile)
+        if data is None:
+            return
+        send_message(wfile, handle(data))
+
+
+def warm():
+    """Import the rendering modules and start the text engine by writing a small schematic."""
+    from tempfile import TemporaryDirectory
+    from devcs import Device, Layer, Schematic
+    from features import Rectangle
+    import direct
+    import geometry
+    s = Schematic()
+    d = Device()
+    d.stack(Layer(feature=Rectangle(10, 5), text='warm'))
+    s.stack(d)
+    with TemporaryDirectory() as tmp:
+        s.write(os.path.join(tmp, 'warm'))
+        s.write(os.path.join(tmp, 'warm'), backend='direct')
+
+
+def serve_socket(path):
+    """Serve the clients connecting to a Unix socket at path, each connection
+    in a process forked from this warm one, so that clients which keep their
+    connection open (see client) do not hold up the others."""
+    from socketserver import ForkingMixIn, StreamRequestHandler, UnixStreamServer
+
+    class Handler(StreamRequestHandler):
+        def handle(self):
+            serve(self.rfile, self.wfile)
+
+    class Server(ForkingMixIn, UnixStreamServer):
+        block_on_close = False  # connections may last as long as their client
+
+    if os.path.exists(path):
+        os.unlink(path)
+    umask = os.umask(0o177)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(umask)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # remove the socket
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def serve_stdio():
+    """Serve the requests read from stdin, answering on stdout."""
+    rfile, wfile = sys.stdin.buffer, sys.stdout.buffer
+    sys.stdout = sys.stderr  # keep printed output out of the replies
+    serve(rfile, wfile)
+
+
+class Client:
+    """A connection to a render server.
+
+    address:
+        type: str
+        default: None
+        description: the path of the Unix socket of a running server; if None
+            a server is started as a child process talking over its stdin and stdout
+
+    """
+
+    def __init__(self, address=None):
+        self.address = address
+        self.process = None
+        self.sock = None
+        if address is None:
+            self.process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--stdio'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                env=dict(os.environ, **{env_var: ''}))
+            self.wfile, self.rfile = self.process.stdin, self.process.stdout
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(address)
+            except OSError as e:
+                self.sock.close()
+                raise ServerUnavailable('cannot connect to the render server at %s: %s'
+                                        % (address, e)) from e
+            self.rfile = self.sock.makefile('rb')
+            self.wfile = self.sock.makefile('wb')
+
+    def write(self, schematic, filename='schematic', **kwargs):
+        """Write a schematic on the server as Schematic.write(filename, **kwargs)
+        and return the path of the written file. An error of the server is
+        raised again with its type (or as RuntimeError if it cannot be
+        pickled), with the server traceback as its cause. The options which
+        live in this process, stats and cache, raise a ValueError and
+        ServerUnavailable is raised if the server cannot be reached."""
+        if kwargs.get('stats') is not None or kwargs.get('cache') is not None:
+            raise ValueError('stats and cache cannot be sent to the render server')
+        try:
+            send_message(self.wfile, dict(schematic=schematic, filename=filename,
+                                          kwargs=kwargs, cwd=os.getcwd()))
+            data = recv_message(self.rfile)
+        except OSError as e:
+            raise ServerUnavailable('the render server connection failed: %s' % e) from e
+        if data is None:
+            raise ServerUnavailable('the render server closed the connection')
+        response = pickle.loads(data)
+        if response['error'] is not None:
+            exception = None
+            if response.get('exception') is not None:
+                try:
+                    exception = pickle.loads(response['exception'])
+                except Exception:
+                    pass
+            if not isinstance(exception, Exception):
+                exception = RuntimeError('render server error')
+            raise exception from RemoteTraceback(response['error'])
+        return response['path']
+
+    def close(self):
+        self.wfile.close()
+        self.rfile.close()
+        if self.sock is not None:
+            self.sock.close()
+        if self.process is not None:
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_clients = {}
+
+
+def client(address):
+    """Return the connection of this process to the server at address, made once."""
+    if address not in _clients:
+        _clients[address] = Client(address)
+    return _clients[address]
+
+
+def write_remote(address, schematic, filename, **kwargs):
+    """Write a schematic on the server at address over the connection of this
+    process (see Schematic.write). If the server cannot be reached, warn and
+    return False so that the caller writes the schematic itself."""
+    try:
+        client(address).write(schematic, filename, **kwargs)
+    except ServerUnavailable as e:
+        stale = _clients.pop(address, None)
+        if stale is not None:
+            try:
+                stale.close()
+            except OSError:
+                pass
+        warnings.warn('%s; writing %s in this process' % (e, filename))
+        return False
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--socket', help='path of the Unix socket to listen on')
+    group.add_argument('--stdio', action='store_true',
+                       help='read requests from stdin and reply on stdout')
+    args = parser.parse_args(argv)
+    os.environ.pop(env_var, None)  # the server writes schematics itself
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    warm()
+    if args.stdio:
+        serve_stdio()
+    else:
+        serve_socket(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""Spatial index over the devices and layers of a schematic for point and window queries.
+
+The bounding boxes are taken from the device shifts of Schematic.stack and the
+layer positions and heights, without placing any feature, and bucketed in a
+uniform grid, so a query only looks at the boxes in the grid cells it covers.
+"""
+from features import Bbox
+from math import floor
+from numpy import (arange, array, concatenate, lexsort, maximum, minimum, repeat,
+                   unique, zeros)
+
+
+class GridIndex:
+    """A uniform grid of buckets over a set of bounding boxes.
+
+    boxes:
+        type: array
+        description: (N, 4) bounding boxes (x1, y1, x2, y2)
+    cell:
+        type: 2-tuple
+        default: mean box width and height
+        description: the width and height of a grid cell
+
+    """
+
+    def __init__(self, boxes, cell=None):
+        self.boxes = array(boxes, dtype=float).reshape(-1, 4)
+        boxes = self.boxes
+        if cell is None:
+            if len(boxes):
+                cell = (float(max(1e-9, (boxes[:, 2] - boxes[:, 0]).mean())),
+                        float(max(1e-9, (boxes[:, 3] - boxes[:, 1]).mean())))
+            else:
+                cell = (1., 1.)
+        self.cell = cell
+        self.origin = (boxes[:, 0].min(), boxes[:, 1].min()) if len(boxes) else (0., 0.)
+        # (cell, box) pairs of every cell covered by each box, grouped by cell
+        ox, oy = self.origin
+        i0 = ((boxes[:, 0] - ox) // cell[0]).astype(int)
+        j0 = ((boxes[:, 1] - oy) // cell[1]).astype(int)
+        nj = ((boxes[:, 3] - oy) // cell[1]).astype(int) - j0 + 1
+        counts = (((boxes[:, 2] - ox) // cell[0]).astype(int) - i0 + 1) * nj
+        item = repeat(arange(len(boxes)), counts)
+        k = arange(len(item)) - repeat(counts.cumsum() - counts, counts)
+        ci = i0[item] + k // nj[item]
+        cj = j0[item] + k % nj[item]
+        order = lexsort((item, cj, ci))
+        ci, cj, item = ci[order], cj[order], item[order]
+        self.buckets = {}
+        if len(item):
+            first = concatenate(([True], (ci[1:] != ci[:-1]) | (cj[1:] != cj[:-1])))
+            starts = first.nonzero()[0].tolist() + [len(item)]
+            for s, e in zip(starts[:-1], starts[1:]):
+                self.buckets[(int(ci[s]), int(cj[s]))] = item[s:e]
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def query(self, x1, y1, x2, y2):
+        """Return the sorted indices of the boxes overlapping the window (boundaries included)."""
+        if not len(self.boxes):
+            return zeros(0, dtype=int)
+        (cw, ch), (ox, oy) = self.cell, self.origin
+        i0, i1 = floor((x1 - ox) / cw), floor((x2 - ox) / cw)
+        j0, j1 = floor((y1 - oy) / ch), floor((y2 - oy) / ch)
+        keys = self.buckets
+        # only visit the occupied cells if the window covers more cells than that
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(keys):
+            found = [items for (i, j), items in keys.items()
+                     if i0 <= i <= i1 and j0 <= j <= j1]
+        else:
+            found = [keys[(i, j)] for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)
+                     if (i, j) in keys]
+        if not found:
+            return zeros(0, dtype=int)
+        candidates = unique(concatenate(found))
+        b = self.boxes[candidates]
+        hit = (b[:, 0] <= x2) & (b[:, 2] >= x1) & (b[:, 1] <= y2) & (b[:, 3] >= y1)
+        return candidates[hit]
+
+    def point(self, x, y):
+        """Return the sorted indices of the boxes containing the point."""
+        return self.query(x, y, x, y)
+
+
+class SchematicIndex:
+    """A spatial index of the devices and layers of a schematic (see Schematic.index).
+    The index is not updated when the schematic changes.
+
+    schematic:
+        type: Schematic
+        description: the indexed schematic
+    devices:
+        type: GridIndex
+        description: the device bounding boxes, in the order of schematic.devices_xy
+    layers:
+        type: GridIndex
+        description: the layer bounding boxes of all devices
+    layer_device:
+        type: array
+        description: the device index of each layer in layers
+    layer_index:
+        type: array
+        description: the index of each layer in layers within its device
+
+    """
+
+    def __init__(self, schematic, cell=None):
+        self.schematic = schematic
+        self._devices = []
+        boxes, devices, indices = [], [], []
+        for d, (device, (xshift, yshift)) in enumerate(schematic.devices_xy):
+            self._devices.append((device, xshift, yshift, list(device.layers_yh)))
+            for l, (layer, ly, h) in enumerate(self._devices[-1][3]):
+                y = yshift + ly
+                boxes.append((xshift, y, xshift + device.width, y + h))
+                devices.append(d)
+                indices.append(l)
+        boxes = array(boxes, dtype=float).reshape(-1, 4)
+        self.layers = GridIndex(boxes, cell)
+        self.layer_device = array(devices, dtype=int)
+        self.layer_index = array(indices, dtype=int)
+        self._starts = concatenate(([0], array([len(d[3]) for d in self._devices],
+                                               dtype=int).cumsum()))
+        dboxes = []
+        for d, (device, xshift, yshift, layers_yh) in enumerate(self._devices):
+            own = boxes[self._starts[d]:self._starts[d + 1]]
+            if len(own):
+                dboxes.append((own[:, 0].min(), own[:, 1].min(),
+                               own[:, 2].max(), own[:, 3].max()))
+            else:
+                dboxes.append((xshift, yshift, xshift + device.width, yshift))
+        self.devices = GridIndex(dboxes)
+
+    def device_bbox(self, d):
+        return Bbox(*self.devices.boxes[d].tolist())
+
+    def layer_bbox(self, d, l):
+        return Bbox(*self.layers.boxes[self._starts[d] + l].tolist())
+
+    def at(self, x, y):
+        """Return the (device, layer) indices of the layers containing the point."""
+        hits = self.layers.point(x, y)
+        return list(zip(self.layer_device[hits].tolist(), self.layer_index[hits].tolist()))
+
+    def overlapping(self, bbox):
+        """Return the (device, layer) indices of the layers overlapping a Bbox."""
+        hits = self.layers.query(*bbox)
+        return list(zip(self.layer_device[hits].tolist(), self.layer_index[hits].tolist()))
+
+    def devices_at(self, x, y):
+        """Return the indices of the devices containing the point."""
+        return self.devices.point(x, y).tolist()
+
+    def devices_overlapping(self, bbox):
+        """Return the indices of the devices overlapping a Bbox."""
+        return self.devices.query(*bbox).tolist()
+
+    def instances(self, d, l, bbox):
+        """Return the x-positions of the instances of the feature of layer l of
+        device d that are visible in the device and overlap a Bbox."""
+        device, xshift, yshift, layers_yh = self._devices[d]
+        layer, ly, h = layers_yh[l]
+        lbox, inside, crossing = layer.visible(xshift, yshift + ly, device.width, h)
+        xs = concatenate((inside, array(crossing, dtype=float)))
+        fbbox = layer.feature.get_bbox(0, yshift + ly)
+        # the visible part of each instance is its bbox cut to the layer bbox
+        x1 = maximum(xs + fbbox.x1, lbox.x1)
+        x2 = minimum(xs + fbbox.x2, lbox.x2)
+        y1, y2 = max(fbbox.y1, lbox.y1), min(fbbox.y2, lbox.y2)
+        if y1 > bbox.y2 or y2 < bbox.y1:
+            return xs[:0]
+        xs = xs[(x1 <= bbox.x2) & (x2 >= bbox.x1)]
+        xs.sort()
+        return xs
+
+    def canvas(self, bbox, batched=False):
+        """Return a pyx canvas, clipped to a Bbox, of the layers overlapping it
+        and the schematic canvas."""
+        from pyx import canvas as pyxcanvas
+        from devcs import layer_canvas
+        canvas = pyxcanvas.canvas([pyxcanvas.clip(bbox.to_path())])
+        canvas.insert(self.schematic.canvas)
+        for d, l in self.overlapping(bbox):
+            device, xshift, yshift, layers_yh = self._devices[d]
+            layer, ly, h = layers_yh[l]
+            canvas.insert(layer_canvas(layer.place(xshift, yshift + ly, device.width,
+                                                   batched, height=h)))
+        return canvas
+
+    def write(self, filename, bbox, format='eps', batched=False, frame=False):
+        """Write only the layers overlapping a Bbox, clipped to it, to an EPS or SVG file.
+        If frame, the page bounding box is the Bbox itself rather than that of the
+        drawn content, so that the files of adjacent windows line up."""
+        if format not in ('eps', 'svg'):
+            raise ValueError('unknown format %r' % format)
+        from devcs import labels
+        labels.typeset(layer.text for d, l in self.overlapping(bbox)
+                       for layer in (self._devices[d][3][l][0],) if layer.text != '')
+        canvas = self.canvas(bbox, batched)
+        kwargs = {}
+        if frame:
+            kwargs['page_bbox'] = bbox.to_path().bbox()
+        if format == 'svg':
+            canvas.writeSVGfile(filename, **kwargs)
+        else:
+            canvas.writeEPSfile(filename, **kwargs)
@@ -0,0 +1,80 @@
+"""Parameter sweeps: build and write a schematic for every point of a grid of parameters.
+
+The grid is held as flat NumPy columns, one per parameter, so derived
+parameters (periods, offsets, see convfuncs) are computed for all points at
+once. Features and layers requested through the sweep are memoized, so points
+sharing them share the same objects, and the variants are written as one batch
+which reuses the placed layers that are the same between points.
+"""
+from numpy import asarray, meshgrid
+
+
+class Sweep:
+    """A grid of parameters, with every combination of the values of each axis.
+
+    axes:
+        type: keyword arguments
+        description: the values of each parameter, e.g. dwidth=(100, 147), num=range(1, 5)
+    grid:
+        type: dict
+        description: a column (1D array) of the value at each point for each
+            parameter; derived parameters may be added as further columns
+
+    """
+
+    def __init__(self, **axes):
+        values = [asarray(v) for v in axes.values()]
+        mesh = meshgrid(*values, indexing='ij') if values else []
+        self.grid = {name: m.ravel() for name, m in zip(axes, mesh)}
+        self._features = {}
+        self._layers = {}
+
+    def __len__(self):
+        return len(next(iter(self.grid.values()))) if self.grid else 0
+
+    def points(self):
+        """Yield the parameters of each point as a dict of Python scalars."""
+        names = list(self.grid)
+        for values in zip(*(self.grid[n].tolist() for n in names)):
+            yield dict(zip(names, values))
+
+    def feature(self, cls, *args, **kwargs):
+        """Return the feature cls(*args, **kwargs), made once for the sweep."""
+        key = (cls, args, tuple(sorted(kwargs.items(), key=lambda kv: kv[0])))
+        try:
+            return self._features[key]
+        except TypeError:  # unhashable arguments
+            return cls(*args, **kwargs)
+        except KeyError:
+            feature = self._features[key] = cls(*args, **kwargs)
+            return feature
+
+    def layer(self, **kwargs):
+        """Return Layer(**kwargs), shared by all points with a layer of the same content."""
+        from devcs import Layer
+        layer = Layer(**kwargs)
+        return self._layers.setdefault(layer.key(), layer)
+
+    def schematics(self, build):
+        """Return the schematic build(**point) of each point."""
+        return [build(**point) for point in self.points()]
+
+    def write(self, build, filename='sweep', workers=1, cache=None, **kwargs):
+        """Write the schematic build(**point) of each point to filename_<index>.
+
+        With workers=1 the variants are written in this process with one
+        RenderCache (made here unless given, for the pyx backends which use
+        one), so layers placed identically in
+        several variants are placed once; otherwise they are written over a
+        process pool with render.render_many. Keyword arguments are passed on to
+        Schematic.write. Returns the RenderResult of each variant in order."""
+        from render import render_many, render_one
+        jobs = (('%s_%d' % (filename, i), build(**point))
+                for i, point in enumerate(self.points()))
+        if workers != 1:
+            return render_many(((s, f) for f, s in jobs), workers, **kwargs)
+        if (cache is None and kwargs.get('backend', 'pyx') == 'pyx' and
+                not kwargs.get('merge') and kwargs.get('workers') is None):
+            from devcs import RenderCache
+            cache = RenderCache()
+        return [render_one(s, f, cache=cache, **kwargs) for f, s in jobs]